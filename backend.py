@@ -1,9 +1,33 @@
 import os
+import re
 import sys
 import time
 import traceback
 import shutil
 import subprocess
+import threading
+import bisect
+import copy
+import itertools
+import json
+import hashlib
+import uuid
+import mmap
+import struct
+import sqlite3
+import unicodedata
+import multiprocessing
+import queue
+import heapq
+import math
+import concurrent.futures
+import contextlib
+import inspect
+import pickle
+import signal
+import socket
+import socketserver
+from collections import OrderedDict
 
 import requests
 from flask import Flask, jsonify, request, stream_with_context
@@ -13,15 +37,12 @@ import appdirs
 
 from gunicorn.app.base import BaseApplication
 
-from pyannote.audio import Pipeline as PyannotePipeline
-
-import whisper
-import whisper.audio
-import torch
 import numpy as np
 from functools import lru_cache
 
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+# torch, whisper, pyannote.audio and transformers take seconds to import, so they're imported
+# by the functions that need them instead of here. That way the backend starts answering
+# /health and /models right away.
 
 # Mapping of language codes to names for Helsinki NLP models, for popular languages:
 # https://huggingface.co/Helsinki-NLP
@@ -57,586 +78,4287 @@ language_codes = {
     "uk": "Ukrainian",
 }
 
-# Monkeypatch whisper to work when frozen with PyInstaller. Otherwise, we end up with an error like this:
-# Traceback (most recent call last):
-#   File "flask/app.py", line 1484, in full_dispatch_request
-#   File "flask/app.py", line 1469, in dispatch_request
-#   File "backend.py", line 343, in transcribe
-#   File "backend.py", line 300, in do_transcribe
-#   File "whisper/transcribe.py", line 121, in transcribe
-#   File "whisper/audio.py", line 141, in log_mel_spectrogram
-#   File "whisper/audio.py", line 94, in mel_filters
-#   File "numpy/lib/npyio.py", line 405, in load
-# FileNotFoundError: [Errno 2] No such file or directory: '/var/folders/91/mf1m_byx43d8v058f2yb4nlm0000gn/T/_MEIz3Pn83/whisper/assets/mel_filters.npz'
-if getattr(sys, "frozen", False):
-
-    @lru_cache(maxsize=None)
-    def my_mel_filters(device, n_mels: int = whisper.audio.N_MELS) -> torch.Tensor:
-        """
-        Modified version of mel_filters function
-        """
-        assert n_mels == 80, f"Unsupported n_mels: {n_mels}"
-        base_path = os.path.dirname(os.path.abspath(__file__))
-        mel_filters_path = os.path.join(base_path, "whisper/assets/mel_filters.npz")
-        with np.load(mel_filters_path) as f:
-            return torch.from_numpy(f[f"mel_{n_mels}"]).to(device)
+MB = 1024 * 1024
+GB = 1024 * MB
+
+# Rough RAM needed to hold each Whisper model in memory, matching the descriptions on the models page
+whisper_ram_estimates = {
+    "small": 2 * GB,
+    "medium": 5 * GB,
+    "large": 10 * GB,
+    "small-int8": 1 * GB,
+    "medium-int8": 2 * GB,
+    "large-int8": 4 * GB,
+}
 
-    whisper.audio.mel_filters = my_mel_filters
+# Rough RAM needed to hold the pyannote pipeline in memory
+pyannote_ram_estimate = 100 * MB
+
+# Rough RAM needed to hold a Helsinki NLP model and its tokenizer in memory
+translate_ram_estimate = 500 * MB
+translate_int8_ram_estimate = 200 * MB
+
+# Rough RAM a transcription needs for each second of audio on top of its models, for the decoded
+# samples, the copies whisper and pyannote make of them, and the spectrograms
+transcribe_ram_per_second = MB // 2
+
+# Rough RAM a translation needs on top of its model, while generating
+translate_working_ram_estimate = 100 * MB
+
+# Requests waiting for memory are let in this order
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+# Quantized models have the same name as the model they're made from, with this at the end
+QUANTIZED_SUFFIX = "-int8"
+
+# Downloads are read in chunks this big, and fetched in pieces this big when using parallel
+# connections. Dropped connections are retried this many times before giving up.
+DOWNLOAD_CHUNK_SIZE = 1 * MB
+DOWNLOAD_PIECE_SIZE = 16 * MB
+DOWNLOAD_CONNECTIONS = 4
+DOWNLOAD_RETRIES = 3
+
+# Whisper and pyannote both work with 16 kHz mono audio
+SAMPLE_RATE = 16000
+
+# Transcribe long recordings this many seconds at a time, so jobs can report progress and be
+# canceled in between
+TRANSCRIBE_WINDOW_SECONDS = 300
+
+# Parallel transcriptions split the audio into chunks of about this many seconds at quiet
+# moments, with this much overlap on each side
+PARALLEL_CHUNK_SECONDS = 120
+PARALLEL_OVERLAP_SECONDS = 2
+
+# Speech regions found by voice activity detection are padded by this much on each side, so
+# words at the edges don't get clipped
+VAD_PADDING_SECONDS = 0.5
+
+# Streaming transcriptions use short windows, so the first text shows up quickly
+STREAM_WINDOW_SECONDS = 30
+
+# How many sentences to translate in a single call to generate, and how many tokens its padded
+# batch can hold
+TRANSLATE_BATCH_SIZE = 16
+TRANSLATE_BATCH_TOKENS = 4096
+
+# SentencePiece tokens are about this many characters long, for guessing the size of a batch
+# before it's tokenized
+CHARACTERS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def import_whisper():
+    # Imports whisper the first time it's needed, and patches it
+    import torch
+    import whisper
+    import whisper.audio
+
+    # Monkeypatch whisper to work when frozen with PyInstaller. Otherwise, we end up with an error like this:
+    # Traceback (most recent call last):
+    #   File "flask/app.py", line 1484, in full_dispatch_request
+    #   File "flask/app.py", line 1469, in dispatch_request
+    #   File "backend.py", line 343, in transcribe
+    #   File "backend.py", line 300, in do_transcribe
+    #   File "whisper/transcribe.py", line 121, in transcribe
+    #   File "whisper/audio.py", line 141, in log_mel_spectrogram
+    #   File "whisper/audio.py", line 94, in mel_filters
+    #   File "numpy/lib/npyio.py", line 405, in load
+    # FileNotFoundError: [Errno 2] No such file or directory: '/var/folders/91/mf1m_byx43d8v058f2yb4nlm0000gn/T/_MEIz3Pn83/whisper/assets/mel_filters.npz'
+    if getattr(sys, "frozen", False):
+
+        @lru_cache(maxsize=None)
+        def my_mel_filters(device, n_mels: int = whisper.audio.N_MELS) -> torch.Tensor:
+            """
+            Modified version of mel_filters function
+            """
+            assert n_mels == 80, f"Unsupported n_mels: {n_mels}"
+            base_path = os.path.dirname(os.path.abspath(__file__))
+            mel_filters_path = os.path.join(base_path, "whisper/assets/mel_filters.npz")
+            with np.load(mel_filters_path) as f:
+                return torch.from_numpy(f[f"mel_{n_mels}"]).to(device)
+
+        whisper.audio.mel_filters = my_mel_filters
+
+    # Let whisper use spectrograms from the feature cache, see AudioFeatures
+    transcribe_module = sys.modules["whisper.transcribe"]
+    original_log_mel_spectrogram = transcribe_module.log_mel_spectrogram
+
+    def log_mel_spectrogram(audio, n_mels=80, padding=0, device=None):
+        features = getattr(audio_features, "current", None)
+        log_spec = features and features.window_log_mel(audio, n_mels, padding)
+        if log_spec is None:
+            return original_log_mel_spectrogram(audio, n_mels, padding, device)
+        return log_spec.to(device) if device is not None else log_spec
+
+    transcribe_module.log_mel_spectrogram = log_mel_spectrogram
+    return whisper
 
 
 # Helpers
 
 
 def get_config_dir():
-    return appdirs.user_config_dir("NeuronBox")
+    return os.environ.get("NEURONBOX_CONFIG_DIR") or appdirs.user_config_dir(
+        "NeuronBox"
+    )
 
 
 def get_models_dir():
     return os.path.join(get_config_dir(), "models")
 
 
-def get_download_status_dir():
-    return os.path.join(get_config_dir(), "download_status")
+def get_cache_path():
+    return os.path.join(get_config_dir(), "cache.sqlite3")
 
 
-def get_ffmpeg_path():
-    # TODO: if frozen, use the ffmpeg binary in the app bundle
-    return shutil.which("ffmpeg")
+def get_result_cache_size():
+    # How many MB of transcription results to keep around
+    return int(float(os.environ.get("NEURONBOX_RESULT_CACHE_MB", 256)) * MB)
 
 
-class DownloadStatus:
-    def __init__(self, key):
-        self.key = key.replace("/", "_")
-        self.progress = 0
-        self.status_filename = os.path.join(
-            get_download_status_dir(), f"{self.key}.status"
-        )
-        self.cancel_filename = os.path.join(
-            get_download_status_dir(), f"{self.key}.cancel"
-        )
+def get_feature_cache_dir():
+    return os.path.join(get_config_dir(), "features")
 
-        self._load_status()
-        self.update(self.progress)
 
-    def _load_status(self):
-        if os.path.exists(self.status_filename):
-            with open(self.status_filename, "r") as f:
-                try:
-                    self.progress = float(f.read())
-                except ValueError:
-                    self.progerss = 0
+def get_feature_cache_size():
+    # How many MB of decoded audio and spectrograms to keep around on disk
+    return int(float(os.environ.get("NEURONBOX_FEATURE_CACHE_MB", 2048)) * MB)
 
-        self.canceled = os.path.exists(self.cancel_filename)
 
-    def update(self, progress):
-        self.progress = progress
-        with open(self.status_filename, "w") as f:
-            f.write(str(progress))
+def get_translation_memory_size():
+    # How many MB of translated sentences to keep around on disk
+    return int(float(os.environ.get("NEURONBOX_TRANSLATION_MEMORY_MB", 64)) * MB)
 
-    def cancel(self):
-        self.canceled = True
-        with open(self.cancel_filename, "w") as f:
-            f.write("canceled")
 
-    def is_canceled(self):
-        self._load_status()
-        return self.canceled
+def get_translate_batch_window():
+    # How long to wait for other translation requests for the same model, to translate together
+    return float(os.environ.get("NEURONBOX_TRANSLATE_BATCH_WINDOW_MS", 10)) / 1000
 
-    def clean(self):
-        if os.path.exists(self.status_filename):
-            os.remove(self.status_filename)
-        if os.path.exists(self.cancel_filename):
-            os.remove(self.cancel_filename)
 
+def get_translate_batch_size():
+    return int(os.environ.get("NEURONBOX_TRANSLATE_BATCH_SIZE", TRANSLATE_BATCH_SIZE))
 
-# Create folders if they don't exist
 
-if not os.path.exists(get_models_dir()):
-    os.makedirs(get_models_dir())
+def get_translate_batch_tokens():
+    return int(
+        os.environ.get("NEURONBOX_TRANSLATE_BATCH_TOKENS", TRANSLATE_BATCH_TOKENS)
+    )
 
-if not os.path.exists(get_download_status_dir()):
-    os.makedirs(get_download_status_dir())
 
-# Delete download status files left over from last time
-for filename in os.listdir(get_download_status_dir()):
-    os.remove(os.path.join(get_download_status_dir(), filename))
+def get_ffmpeg_path():
+    # TODO: if frozen, use the ffmpeg binary in the app bundle
+    return shutil.which("ffmpeg")
 
 
-# Create the flask app
+class DownloadProgressRegistry:
+    """
+    Download progress and cancel flags, shared between all of the web server's worker
+    processes. It's an anonymous shared memory map that gets created when this module is
+    imported, before gunicorn forks its workers, so every worker sees the same memory. Reading
+    and writing it doesn't make any system calls.
+    """
+
+    # Each slot is a key, progress, a version that gets bumped on every change, whether the
+    # slot is in use, and whether the download was canceled
+    slot_format = struct.Struct("<128sdIBB")
+    slot_count = 64
+
+    def __init__(self):
+        self.memory = mmap.mmap(-1, self.slot_format.size * self.slot_count)
+        self.lock = multiprocessing.Lock()
+
+    def _read(self, index):
+        return self.slot_format.unpack_from(self.memory, index * self.slot_format.size)
+
+    def _write(self, index, key, progress, version, in_use, canceled):
+        self.slot_format.pack_into(
+            self.memory,
+            index * self.slot_format.size,
+            key,
+            progress,
+            version & 0xFFFFFFFF,
+            in_use,
+            canceled,
+        )
 
-app = Flask(__name__)
-CORS(app)  # TODO: restrict origins to just localhost
+    def _find(self, key):
+        key = key.encode()[:128].ljust(128, b"\0")
+        for index in range(self.slot_count):
+            slot_key, _, _, in_use, _ = self._read(index)
+            if in_use and slot_key == key:
+                return index, key
+        return None, key
+
+    def claim(self, key):
+        # Returns a free slot's index for key, or None if key is already downloading
+        with self.lock:
+            index, key = self._find(key)
+            if index is not None:
+                return None
+
+            for index in range(self.slot_count):
+                _, _, version, in_use, _ = self._read(index)
+                if not in_use:
+                    self._write(index, key, 0, version + 1, 1, 0)
+                    return index
+
+        raise RuntimeError("Too many downloads in progress")
+
+    def get(self, key):
+        # Returns (progress, version, canceled), or None if there's no download with this key
+        index, _ = self._find(key)
+        if index is None:
+            return None
+        _, progress, version, _, canceled = self._read(index)
+        return progress, version, bool(canceled)
+
+    def update(self, index, progress=None, canceled=None):
+        with self.lock:
+            key, old_progress, version, in_use, old_canceled = self._read(index)
+            self._write(
+                index,
+                key,
+                old_progress if progress is None else progress,
+                version + 1,
+                in_use,
+                old_canceled if canceled is None else canceled,
+            )
 
+    def cancel(self, key):
+        # Returns whether there was a download with this key to cancel
+        with self.lock:
+            index, _ = self._find(key)
+            if index is None:
+                return False
+            slot_key, progress, version, in_use, _ = self._read(index)
+            self._write(index, slot_key, progress, version + 1, in_use, 1)
+            return True
 
-@app.errorhandler(Exception)
-def handle_exception(e):
-    # Capture the stack trace
-    trace = traceback.format_exc()
-    # Log it, send it to an external service, etc.
-    app.logger.error(trace)
-    return str(e), 500
+    def is_canceled(self, index):
+        return bool(self._read(index)[4])
 
+    def release(self, index):
+        with self.lock:
+            _, _, version, _, _ = self._read(index)
+            self._write(index, b"", 0, version + 1, 0, 0)
 
-# Health check
-@app.route("/health")
-def health():
-    return "OK"
 
+class DownloadStatus:
+    # Only publish progress this often, or when it has moved this many percent
+    update_interval = 0.25
+    update_step = 1
 
-# Models
+    def __init__(self, key, index):
+        self.key = key
+        self.index = index
+        self.progress = 0
+        self.published_progress = 0
+        self.last_update = 0
 
+    def update(self, progress):
+        self.progress = progress
+        now = time.monotonic()
+        if (
+            now - self.last_update < self.update_interval
+            and progress - self.published_progress < self.update_step
+            and progress < 100
+        ):
+            return
 
-def download(download_url, filename, key, model):
-    canceled_early = False
-    status = DownloadStatus(key)
+        self.last_update = now
+        self.published_progress = progress
+        download_progress.update(self.index, progress=progress)
 
-    try:
-        with requests.get(download_url, stream=True) as r:
-            r.raise_for_status()
-            total_size = int(r.headers.get("content-length", 0))
-            block_size = 1024  # 1 Kbyte
-            progress = tqdm(total=total_size, unit="B", unit_scale=True, desc=model)
-            with open(filename, "wb") as f:
-                for data in r.iter_content(block_size):
-                    f.write(data)
-                    progress.update(len(data))
-                    status.update((progress.n / total_size) * 100)
-
-                    # Canceled early?
-                    if status.is_canceled():
-                        print("Canceled download detected, deleting partial model")
-                        canceled_early = True
-                        try:
-                            os.remove(filename)
-                        except FileNotFoundError:
-                            pass
-                        break
-
-            progress.close()
-
-            status.clean()
-
-            if not canceled_early and total_size != 0 and progress.n != total_size:
-                error_message = "Downloaded data size does not match expected size"
-                print(f"Error: {error_message}")
-                return jsonify(
-                    {
-                        "success": False,
-                        "error": error_message,
-                    }
-                )
+    @classmethod
+    def claim(cls, key):
+        # Returns None if key is already downloading. The slot stays claimed, and can be
+        # canceled, until clean() is called.
+        index = download_progress.claim(key)
+        return None if index is None else cls(key, index)
 
-    except (
-        requests.ConnectionError,
-        requests.Timeout,
-        requests.RequestException,
-    ) as e:
-        status.clean()
+    def is_canceled(self):
+        return download_progress.is_canceled(self.index)
 
-        # Delete the model if the download has started
-        try:
-            os.remove(filename)
-        except FileNotFoundError:
-            pass
+    def clean(self):
+        download_progress.release(self.index)
+
+
+download_progress = DownloadProgressRegistry()
+
+
+class Metrics:
+    """
+    Histograms of how long each stage of a request takes, and counters, for /metrics in the
+    Prometheus text format. Like download progress, they're kept in shared memory that's mapped
+    before gunicorn forks its workers, so every worker adds to the same numbers.
+    """
+
+    stages = [
+        "cache",
+        "decode",
+        "whisper_load",
+        "pyannote_load",
+        "diarization",
+        "asr",
+        "translate_load",
+        "translation_memory",
+        "tokenize",
+        "generate",
+        "download",
+        "quantize",
+        "convert",
+        "translate_batch",
+        "admission",
+        "mel",
+    ]
+    buckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600]
+    counters = {
+        "transcriptions_total": "Transcriptions finished",
+        "transcription_cache_hits_total": "Transcriptions answered from the result cache",
+        "audio_seconds_total": "Seconds of audio transcribed",
+        "translations_total": "Translations finished",
+        "translated_sentences_total": "Sentences translated",
+        "translation_memory_hits_total": "Sentences answered from the translation memory",
+        "download_bytes_total": "Bytes of models downloaded",
+        "translation_batches_total": "Batches of sentences translated together",
+        "admission_rejections_total": "Requests turned away because too many were waiting for memory",
+        "feature_cache_hits_total": "Decoded audio and spectrograms loaded from the feature cache",
+    }
 
-        # Specific error handling for each exception type
-        if isinstance(e, requests.ConnectionError):
-            error_message = "Failed to establish a connection. Please check your internet connection."
-        elif isinstance(e, requests.Timeout):
-            error_message = "The request timed out. Please try again later."
-        else:
-            error_message = f"An error occurred while downloading: {str(e)}"
+    def __init__(self):
+        # Each stage has a count for every bucket, then +Inf (the total count), then the sum
+        self.stage_size = len(self.buckets) + 2
+        size = len(self.stages) * self.stage_size + len(self.counters)
+        self.buffer = mmap.mmap(-1, size * 8)
+        self.values = np.frombuffer(self.buffer, dtype=np.float64)
+        self.counter_offset = len(self.stages) * self.stage_size
+        self.lock = multiprocessing.Lock()
+
+    def observe(self, stage, seconds):
+        if stage not in self.stages:
+            return
+        offset = self.stages.index(stage) * self.stage_size
+        with self.lock:
+            for i, bucket in enumerate(self.buckets):
+                if seconds <= bucket:
+                    self.values[offset + i] += 1
+            self.values[offset + len(self.buckets)] += 1
+            self.values[offset + len(self.buckets) + 1] += seconds
+
+    def increment(self, counter, amount=1):
+        index = self.counter_offset + list(self.counters).index(counter)
+        with self.lock:
+            self.values[index] += amount
+
+    def render(self):
+        with self.lock:
+            values = self.values.copy()
+
+        lines = [
+            "# HELP neuronbox_stage_seconds Time spent in each stage of handling requests",
+            "# TYPE neuronbox_stage_seconds histogram",
+        ]
+        for i, stage in enumerate(self.stages):
+            offset = i * self.stage_size
+            for j, bucket in enumerate(self.buckets + ["+Inf"]):
+                lines.append(
+                    f'neuronbox_stage_seconds_bucket{{stage="{stage}",le="{bucket}"}} {values[offset + j]:g}'
+                )
+            lines.append(
+                f'neuronbox_stage_seconds_sum{{stage="{stage}"}} {values[offset + len(self.buckets) + 1]:g}'
+            )
+            lines.append(
+                f'neuronbox_stage_seconds_count{{stage="{stage}"}} {values[offset + len(self.buckets)]:g}'
+            )
 
-        print(f"Error: {error_message}")
-        return jsonify(
-            {
-                "success": False,
-                "error": error_message,
-            }
-        )
+        for i, (counter, description) in enumerate(self.counters.items()):
+            lines.append(f"# HELP neuronbox_{counter} {description}")
+            lines.append(f"# TYPE neuronbox_{counter} counter")
+            lines.append(f"neuronbox_{counter} {values[self.counter_offset + i]:g}")
+        return "\n".join(lines) + "\n"
 
 
-@app.route("/models")
-def models():
-    # Transcribe models
-    pyannote_dir = os.path.join(get_models_dir(), "pyannote")
-    if not os.path.exists(pyannote_dir):
-        os.makedirs(pyannote_dir)
+metrics = Metrics()
 
-    pyannote_model_downloaded = os.path.exists(
-        os.path.join(pyannote_dir, "pytorch_model.bin")
-    )
-    if pyannote_model_downloaded:
-        pyannote_model_size = os.path.getsize(
-            os.path.join(pyannote_dir, "pytorch_model.bin")
-        )
-    else:
-        pyannote_model_size = 0
 
-    whisper_dir = os.path.join(get_models_dir(), "whisper")
-    if not os.path.exists(whisper_dir):
-        os.makedirs(whisper_dir)
+class Timings:
+    """
+    How long each stage of a single request took, returned in its response as "timings". Every
+    stage is also recorded in the metrics.
+    """
 
-    whispers_small_downloaded = os.path.exists(os.path.join(whisper_dir, "small.pt"))
-    whispers_medium_downloaded = os.path.exists(os.path.join(whisper_dir, "medium.pt"))
-    whispers_large_downloaded = os.path.exists(os.path.join(whisper_dir, "large.pt"))
+    def __init__(self):
+        self.seconds = {}
+        self.lock = threading.Lock()
 
-    if whispers_small_downloaded:
-        whispers_small_size = os.path.getsize(os.path.join(whisper_dir, "small.pt"))
-    else:
-        whispers_small_size = 0
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0) + seconds
+        metrics.observe(stage, seconds)
 
-    if whispers_medium_downloaded:
-        whispers_medium_size = os.path.getsize(os.path.join(whisper_dir, "medium.pt"))
-    else:
-        whispers_medium_size = 0
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
 
-    if whispers_large_downloaded:
-        whispers_large_size = os.path.getsize(os.path.join(whisper_dir, "large.pt"))
-    else:
-        whispers_large_size = 0
-
-    # Translate models
-    # (start with only target language English)
-    helsinki_dir = os.path.join(get_models_dir(), "Helsinki-NLP")
-    if not os.path.exists(helsinki_dir):
-        os.makedirs(helsinki_dir)
-
-    translate_models = []
-    for language_code in language_codes:
-        # Skip English, since we don't translate from English to English
-        if language_code == "en":
-            continue
+    def timed(self, stage, fn):
+        # Wraps fn so calls to it are timed, like a model loader that may or may not get called
+        def wrapper(*args, **kwargs):
+            with self.stage(stage):
+                return fn(*args, **kwargs)
 
-        language_name = language_codes[language_code]
+        return wrapper
 
-        model_path = os.path.join(helsinki_dir, f"opus-mt-{language_code}-en")
-        is_downloaded = os.path.isdir(model_path)
-        if is_downloaded:
-            size = sum(
-                os.path.getsize(os.path.join(model_path, f))
-                for f in os.listdir(model_path)
-                if os.path.isfile(os.path.join(model_path, f))
-            )
-        else:
-            size = 0
+    def timed_iter(self, stage, iterable):
+        # Times producing each item, but not what the caller does with it in between
+        iterator = iter(iterable)
+        while True:
+            with self.stage(stage):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
 
-        translate_models.append(
-            {
-                "name": f"opus-mt-{language_code}-en",
-                "description": f"{language_name} to English",
-                "downloaded": is_downloaded,
-                "size": size,
-            }
-        )
+    def to_dict(self):
+        with self.lock:
+            return dict(self.seconds)
 
-    return jsonify(
-        {
-            "models": {
-                "transcribe": [
-                    {
-                        "name": "speaker-diarization",
-                        "description": "Speaker diarization, required for transcription",
-                        "downloaded": pyannote_model_downloaded,
-                        "size": pyannote_model_size,
-                    },
-                    {
-                        "name": "small",
-                        "description": "Small, requires ~2GB RAM",
-                        "downloaded": whispers_small_downloaded,
-                        "size": whispers_small_size,
-                    },
-                    {
-                        "name": "medium",
-                        "description": "Medium, requires ~5GB RAM",
-                        "downloaded": whispers_medium_downloaded,
-                        "size": whispers_medium_size,
-                    },
-                    {
-                        "name": "large",
-                        "description": "Large, requires ~10GB RAM",
-                        "downloaded": whispers_large_downloaded,
-                        "size": whispers_large_size,
-                    },
-                ],
-                "translate": translate_models,
-            }
-        }
-    )
 
+def get_total_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
 
-@app.route("/models/download", methods=["POST"])
-def models_download():
-    feature = request.json.get("feature")
-    model = request.json.get("model")
-    key = f"{feature}_{model}"
-    print(f"Starting download: {key}")
 
-    DownloadStatus(key)
+def get_model_memory_budget():
+    # Configurable with NEURONBOX_MODEL_MEMORY_GB, otherwise use half of the physical RAM
+    budget_gb = os.environ.get("NEURONBOX_MODEL_MEMORY_GB")
+    if budget_gb:
+        return int(float(budget_gb) * GB)
 
-    if feature not in ["transcribe", "translate"]:
-        return jsonify({"success": False, "error": f"Invalid feature: {feature}"})
+    total_memory = get_total_memory()
+    if total_memory:
+        return total_memory // 2
+    return 12 * GB
 
-    if feature == "transcribe":
-        if model not in ["speaker-diarization", "small", "medium", "large"]:
-            return jsonify({"success": False, "error": f"Invalid model: {model}"})
 
-        if model == "speaker-diarization":
-            download_url = "https://github.com/micahflee/neuronbox/releases/download/models/pytorch_model.bin"
-            filename = os.path.join(get_models_dir(), "pyannote", "pytorch_model.bin")
+def get_admission_memory_budget():
+    # How much RAM the requests running at the same time can use, for their models and audio.
+    # Configurable with NEURONBOX_ADMISSION_MEMORY_GB, otherwise use 80% of the physical RAM.
+    budget_gb = os.environ.get("NEURONBOX_ADMISSION_MEMORY_GB")
+    if budget_gb:
+        return int(float(budget_gb) * GB)
 
-            # While we're at it, go ahead and manually create the config.yaml instead of downloading
-            config_filename = os.path.join(get_models_dir(), "pyannote", "config.yaml")
-            if not os.path.exists(config_filename):
-                with open(config_filename, "w") as f:
-                    f.write(
-                        f"""pipeline:
-  name: pyannote.audio.pipelines.VoiceActivityDetection
-  params:
-    segmentation: {filename}
+    total_memory = get_total_memory()
+    if total_memory:
+        return total_memory * 4 // 5
+    return 24 * GB
 
-params:
-  min_duration_off: 0.09791355693027545
-  min_duration_on: 0.05537587440407595
-  offset: 0.4806866463041527
-  onset: 0.8104268538848918"""
-                    )
-        else:
-            download_url = whisper._MODELS[model]
-            filename = os.path.join(get_models_dir(), "whisper", f"{model}.pt")
-
-        print(f"Key: {key}: Downloading {download_url} to {filename}")
-
-        ret = download(download_url, filename, key, model)
-        if ret != None:
-            return ret
-
-    elif feature == "translate":
-        valid_model_names = []
-        for language_code in language_codes:
-            if language_code != "en":
-                valid_model_names.append(f"opus-mt-{language_code}-en")
-        if model not in valid_model_names:
-            return jsonify({"success": False, "error": f"Invalid model: {model}"})
-
-        local_dir = os.path.join(get_models_dir(), "Helsinki-NLP", model)
-        if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
-
-        base_url = f"https://huggingface.co/Helsinki-NLP/{model}/resolve/main"
-        filenames = [
-            # tokenizer
-            "tokenizer_config.json",
-            "config.json",
-            "source.spm",
-            "target.spm",
-            "vocab.json",
-            # model
-            "pytorch_model.bin",
-            "generation_config.json",
-        ]
-        for filename in filenames:
-            download_url = f"{base_url}/{filename}"
-            local_filename = os.path.join(local_dir, filename)
 
-            print(f"Key: {key}: Downloading {download_url} to {local_filename}")
-            ret = download(download_url, local_filename, key, model)
-            if ret != None:
-                return ret
+def get_max_waiting_requests():
+    # How many requests can wait for memory before new ones are turned away
+    return int(os.environ.get("NEURONBOX_MAX_WAITING_REQUESTS", 8))
 
-    return jsonify({"success": True})
 
+def get_model_idle_timeout():
+    # Seconds a loaded model can sit unused before it gets unloaded
+    return float(os.environ.get("NEURONBOX_MODEL_IDLE_TIMEOUT", 30 * 60))
 
-@app.route("/download-progress/<feature>/<model>")
-def download_progress_route(feature, model):
-    def generate():
-        key = f"{feature}_{model}"
-        while True:
-            status = DownloadStatus(key)
-            yield f"data:{status.progress}\n\n"
-            time.sleep(1)
 
-    response = app.response_class(
-        stream_with_context(generate()), mimetype="text/event-stream"
-    )
-    response.headers["Cache-Control"] = "no-cache"
-    response.headers["Connection"] = "keep-alive"
-    return response
+def get_parameter_bytes(model):
+    # Models can be stored along with other objects they need, like tokenizers
+    if isinstance(model, (tuple, list)):
+        return sum(get_parameter_bytes(m) for m in model)
 
+    import torch
 
-@app.route("/models/cancel-download", methods=["POST"])
-def cancel_download():
-    feature = request.json.get("feature")
-    model = request.json.get("model")
-    key = f"{feature}_{model}"
-    print(f"Canceling download: {key}")
+    if not isinstance(model, torch.nn.Module):
+        return 0
+    return sum(p.numel() * p.element_size() for p in model.parameters())
 
-    status = DownloadStatus(key)
-    status.cancel()
 
-    return jsonify({"success": True}), 200
+class ModelRegistry:
+    """
+    Keeps loaded models resident in memory, so they don't get loaded from disk on every request.
+    Models are evicted least-recently-used first when the memory budget is exceeded, and unloaded
+    after sitting idle for longer than the idle timeout. Models that are in use are never evicted.
+    """
 
+    def __init__(self, memory_budget, idle_timeout):
+        self.memory_budget = memory_budget
+        self.idle_timeout = idle_timeout
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.RLock()
+        self.reaper = None
 
-@app.route("/models/delete", methods=["POST"])
-def models_delete():
-    feature = request.json.get("feature")
-    model = request.json.get("model")
-    print(f"Deleting model: {feature} {model}")
+    @property
+    def memory_used(self):
+        with self.lock:
+            return sum(entry["size"] for entry in self.entries.values())
 
-    if feature not in ["transcribe", "translate"]:
-        return jsonify({"success": False, "error": f"Invalid feature: {feature}"})
+    def use(self, key, loader, size, exclusive=False):
+        """
+        Lease a model for the duration of a with block. An exclusive lease gets a model instance
+        no other lease is using at the same time, for models that keep state on the module
+        objects while they run (whisper installs its kv-cache hooks on the decoder). Extra
+        instances share the weights of the loaded model, so they cost next to no memory.
+        """
+        return _ModelLease(self, key, loader, size, exclusive)
+
+    def _acquire(self, key, loader, size):
+        with self.lock:
+            if key in self.entries:
+                return self._checkout(key)
+            loading_lock = self.loading.setdefault(key, threading.Lock())
+
+        # Load outside of the registry lock, so other models stay usable during a slow load
+        with loading_lock:
+            with self.lock:
+                if key in self.entries:
+                    return self._checkout(key)
+
+                # Make room first, so we don't briefly hold too many models at once
+                self._evict(size)
+
+            print(f"Loading model: {key}")
+            start_time = time.time()
+            model = loader()
+
+            with self.lock:
+                self.entries[key] = {
+                    "model": model,
+                    "size": size,
+                    "parameter_bytes": get_parameter_bytes(model),
+                    "load_time": time.time() - start_time,
+                    "last_used": time.time(),
+                    "in_use": 0,
+                    "instances": [model],
+                }
+                self.loading.pop(key, None)
+                model = self._checkout(key)
+
+        self._start_reaper()
+        return model
+
+    def _checkout(self, key):
+        entry = self.entries[key]
+        self.entries.move_to_end(key)
+        entry["in_use"] += 1
+        entry["last_used"] = time.time()
+        return entry["model"]
+
+    def _checkout_instance(self, key, model):
+        with self.lock:
+            instances = self.entries[key]["instances"]
+            if instances:
+                return instances.pop()
+        return copy_module_sharing_weights(model)
+
+    def _release(self, key, instance=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry["in_use"] -= 1
+                entry["last_used"] = time.time()
+                if instance is not None:
+                    entry["instances"].append(instance)
+
+    def _evict(self, needed):
+        # Drop least-recently-used models that aren't in use until the new one fits
+        for key in list(self.entries):
+            if self.memory_used + needed <= self.memory_budget:
+                break
+            if self.entries[key]["in_use"] == 0:
+                self.unload(key)
+
+    def unload(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry is not None:
+            print(f"Unloading model: {key}")
+            if isinstance(entry["model"], ParallelPool):
+                entry["model"].close()
+            # No need to import torch just for this, if nothing has imported it yet
+            torch = sys.modules.get("torch")
+            if torch and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def resident_models(self):
+        # (key, size, in use) of each loaded model, least recently used first
+        with self.lock:
+            return [
+                (key, entry["size"], entry["in_use"] > 0)
+                for key, entry in self.entries.items()
+            ]
+
+    def unload_if_idle(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["in_use"]:
+                return False
+            self.unload(key)
+            return True
+
+    def unload_idle(self):
+        now = time.time()
+        with self.lock:
+            idle_keys = [
+                key
+                for key, entry in self.entries.items()
+                if entry["in_use"] == 0 and now - entry["last_used"] > self.idle_timeout
+            ]
+        for key in idle_keys:
+            self.unload(key)
+
+    def _start_reaper(self):
+        with self.lock:
+            if self.reaper is not None:
+                return
+            self.reaper = threading.Thread(target=self._reap, daemon=True)
+        self.reaper.start()
+
+    def _reap(self):
+        while True:
+            time.sleep(min(60, self.idle_timeout))
+            self.unload_idle()
+
+    def status(self):
+        now = time.time()
+        with self.lock:
+            return {
+                "memory_budget": self.memory_budget,
+                "memory_used": self.memory_used,
+                "idle_timeout": self.idle_timeout,
+                "models": [
+                    {
+                        "name": key,
+                        "size": entry["size"],
+                        "parameter_bytes": entry["parameter_bytes"],
+                        "load_time": entry["load_time"],
+                        "idle_time": now - entry["last_used"],
+                        "in_use": entry["in_use"],
+                    }
+                    for key, entry in reversed(self.entries.items())
+                ],
+            }
 
-    if feature == "transcribe":
-        if model not in ["speaker-diarization", "small", "medium", "large"]:
-            return jsonify({"success": False, "error": f"Invalid model: {model}"})
 
-        if model == "speaker-diarization":
-            shutil.rmtree(os.path.join(get_models_dir(), "pyannote"))
-        else:
-            filename = os.path.join(get_models_dir(), "whisper", f"{model}.pt")
-            print(f"Deleting {filename}")
+class _ModelLease:
+    def __init__(self, registry, key, loader, size, exclusive=False):
+        self.registry = registry
+        self.key = key
+        self.loader = loader
+        self.size = size
+        self.exclusive = exclusive
+        self.instance = None
 
+    def __enter__(self):
+        model = self.registry._acquire(self.key, self.loader, self.size)
+        if not self.exclusive:
+            return model
+        try:
+            self.instance = self.registry._checkout_instance(self.key, model)
+        except BaseException:
+            self.registry._release(self.key)
+            raise
+        return self.instance
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.registry._release(self.key, self.instance)
+
+
+def copy_module_sharing_weights(model):
+    # A copy of the module tree that reuses the parameter and buffer tensors, so forward hooks
+    # installed on the copy don't fire for the original. Quantized layers keep their weights
+    # packed in script objects instead of parameters, so those are reused too.
+    import torch
+
+    shared = list(itertools.chain(model.parameters(), model.buffers()))
+    for module in model.modules():
+        shared.extend(
+            value
+            for value in vars(module).values()
+            if isinstance(value, torch.ScriptObject)
+        )
+    return copy.deepcopy(model, {id(value): value for value in shared})
+
+
+def get_inference_workers():
+    # How many jobs can run at the same time
+    return int(os.environ.get("NEURONBOX_INFERENCE_WORKERS", 2))
+
+
+def get_transcribe_workers():
+    # How many processes to split a single transcription across, 1 means don't split it
+    return int(os.environ.get("NEURONBOX_TRANSCRIBE_WORKERS", 1))
+
+
+def get_max_queued_jobs():
+    return int(os.environ.get("NEURONBOX_MAX_QUEUED_JOBS", 32))
+
+
+def get_available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_cpu_threads():
+    # How many cores inference can use in total, split between the jobs that are running.
+    # 0 leaves torch to pick its own thread counts.
+    return int(os.environ.get("NEURONBOX_CPU_THREADS", len(get_available_cores())))
+
+
+def get_cpu_pinning():
+    # Pin each job's threads to its own set of cores
+    return os.environ.get("NEURONBOX_CPU_PINNING", "0") in ("1", "true", "yes")
+
+
+class CPUScheduler:
+    """
+    Splits a budget of CPU cores between the inference work running at the same time, so
+    concurrent jobs don't each start a thread per core and fight over them. Each job gets a
+    slot while it runs. Shares change as jobs start and finish, and each job picks up its new
+    share the next time it calls refresh(), like between transcription windows.
+
+    torch's intra-op thread count (with OpenMP, which torch uses on Linux) and CPU affinity
+    both belong to the calling thread, so a slot only ever changes them from its own thread.
+    """
+
+    def __init__(self, threads, pinning=False):
+        self.enabled = threads > 0
+        self.cores = get_available_cores()[: max(1, threads)]
+        self.threads = max(1, threads)
+        self.pinning = pinning and hasattr(os, "sched_setaffinity")
+        self.lock = threading.Lock()
+        self.slots = []
+        self.local = threading.local()
+        self.interop_threads_set = False
+
+    def _allocate(self):
+        # Split the threads evenly, giving any left over to the jobs that started first, and
+        # hand out consecutive cores to match. Jobs get at least one thread each, even when
+        # there are more jobs than cores.
+        count = len(self.slots)
+        share, extra = divmod(self.threads, count) if count else (0, 0)
+        first = 0
+        for i, slot in enumerate(self.slots):
+            threads = max(1, share + (1 if i < extra else 0))
+            cores = self.cores[first : first + threads] or [
+                self.cores[i % len(self.cores)]
+            ]
+            slot.allocation = (threads, tuple(cores))
+            first += threads
+
+    @contextlib.contextmanager
+    def slot(self):
+        if not self.enabled:
+            yield None
+            return
+
+        slot = CPUSlot(self)
+        with self.lock:
+            self.slots.append(slot)
+            self._allocate()
+        previous = getattr(self.local, "slot", None)
+        self.local.slot = slot
+        try:
+            slot.apply()
+            yield slot
+        finally:
+            self.local.slot = previous
+            with self.lock:
+                self.slots.remove(slot)
+                self._allocate()
+            # Give the thread back its full share, or whatever the outer slot has now
+            if previous:
+                previous.applied = None
+                previous.apply()
+            else:
+                slot.apply((self.threads, tuple(self.cores)))
+
+    def refresh(self):
+        # Pick up a new share for the current thread's slot, if it changed
+        slot = getattr(self.local, "slot", None)
+        if slot:
+            slot.apply()
+
+    def current_threads(self):
+        slot = getattr(self.local, "slot", None)
+        if slot:
+            return slot.allocation[0]
+        return self.threads
+
+
+class CPUSlot:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.allocation = None
+        self.applied = None
+
+    def apply(self, allocation=None):
+        with self.scheduler.lock:
+            allocation = allocation or self.allocation
+        if allocation == self.applied:
+            return
+
+        import torch
+
+        threads, cores = allocation
+        torch.set_num_threads(threads)
+        if not self.scheduler.interop_threads_set:
+            # Inter-op threads are shared by the whole process and can only be set once,
+            # before anything uses them. Whisper and the translation models barely use them,
+            # so the budget goes to intra-op threads instead.
+            self.scheduler.interop_threads_set = True
             try:
-                os.remove(filename)
-            except FileNotFoundError:
+                torch.set_num_interop_threads(1)
+            except RuntimeError:
                 pass
+        if self.scheduler.pinning:
+            os.sched_setaffinity(0, cores)
+        self.applied = allocation
 
-        return jsonify({"success": True}), 200
 
-    if feature == "translate":
-        valid_model_names = []
-        for language_code in language_codes:
-            if language_code != "en":
-                valid_model_names.append(f"opus-mt-{language_code}-en")
-        if model not in valid_model_names:
-            return jsonify({"success": False, "error": f"Invalid model: {model}"})
+cpu_scheduler = CPUScheduler(get_cpu_threads(), get_cpu_pinning())
 
-        model_path = os.path.join(get_models_dir(), "Helsinki-NLP", model)
-        shutil.rmtree(model_path, ignore_errors=True)
-        return jsonify({"success": True}), 200
 
-    return jsonify({"success": False, "error": f"Invalid feature: {feature}"})
+class JobCanceled(Exception):
+    pass
 
 
-# Transcribe
+class JobQueueFull(Exception):
+    pass
 
 
-def do_transcribe(model, filename):
-    # If filename is not a wav file, convert it
-    if not filename.endswith(".wav"):
-        print(f"Converting {filename} to wav")
-        temp_filename = os.path.join(
-            os.path.dirname(filename), f"{os.path.basename(filename)}.wav"
-        )
-        subprocess.run(
-            [
-                get_ffmpeg_path(),
-                "-i",
-                filename,
-                temp_filename,
-            ],
-            check=True,
-        )
-        filename = temp_filename
+class ServerBusy(Exception):
+    # Too many requests are waiting for memory. The message is about how many seconds until
+    # there's room, so it survives being sent back from the model host.
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = float(retry_after)
 
-    # Speaker diarization
-    print(f"Speaker diarization: {filename}")
-    model_config = os.path.join(get_models_dir(), "pyannote", "config.yaml")
-    print(model_config)
-    pipeline = PyannotePipeline(model_config)
-    diarization = pipeline(filename)
 
-    # Print the results
-    for turn, _, speaker in diarization.itertracks(yield_label=True):
-        print(f"start={turn.start:.1f}s stop={turn.end:.1f}s speaker_{speaker}")
+class Job:
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.state = "queued"
+        self.stage = None
+        self.progress = 0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+
+        # Bumped on every change, so watchers can wait for something new
+        self.version = 0
+        self.changed = threading.Condition()
+        self.canceled = threading.Event()
+
+    @property
+    def done(self):
+        return self.state in ("finished", "failed", "canceled")
+
+    def update(self, **fields):
+        with self.changed:
+            for key, value in fields.items():
+                setattr(self, key, value)
+            self.version += 1
+            self.changed.notify_all()
+
+    def wait_for_change(self, version, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def check_canceled(self):
+        if self.canceled.is_set():
+            raise JobCanceled()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "params": self.params,
+            "state": self.state,
+            "stage": self.stage,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
 
-    # TODO: take account of different speakers
 
-    # Transcribe
-    model = whisper.load_model(
-        model, download_root=os.path.join(get_models_dir(), "whisper")
-    )
+class JobQueue:
+    """
+    Runs long jobs on a fixed number of worker threads, so requests can return right away
+    instead of holding a web server worker until the job is done. A job can lend out its slot
+    to run parts of itself side by side, like the files of a batch, with no more running in
+    total than there are workers.
+    """
+
+    def __init__(self, workers, max_queued, keep_finished=100):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.jobs = OrderedDict()
+        self.pending = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.slots = threading.BoundedSemaphore(workers)
+
+    def submit(self, kind, params, fn):
+        with self.lock:
+            queued = sum(1 for job in self.jobs.values() if job.state == "queued")
+            if queued >= self.max_queued:
+                raise JobQueueFull()
+
+            job = Job(kind, params)
+            self.jobs[job.id] = job
+            self._forget_old_jobs()
+            self._start_workers()
+
+        self.pending.put((job, fn))
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is None:
+            return None
+
+        job.canceled.set()
+        if job.state == "queued":
+            job.update(state="canceled", finished=time.time())
+        return job
+
+    def _forget_old_jobs(self):
+        finished = [job.id for job in self.jobs.values() if job.done]
+        for job_id in finished[: max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job_id]
+
+    def _start_workers(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    @contextlib.contextmanager
+    def lend_slot(self):
+        # For a running job, while it waits on parts of itself that take a slot()
+        self.slots.release()
+        try:
+            yield
+        finally:
+            self.slots.acquire()
 
-    print(f"Transcribing: {filename}")
+    def slot(self):
+        return self.slots
 
-    start_time = time.time()
-    result = model.transcribe(filename)
-    elapsed_time = time.time() - start_time
+    def _work(self):
+        while True:
+            job, fn = self.pending.get()
+            if job.canceled.is_set():
+                continue
 
-    print(f"Transcription finished:\n{result['text']}")
-    return {"success": True, "result": result["text"], "time_elapsed": elapsed_time}
+            with self.slots:
+                self._run(job, fn)
 
+    def _run(self, job, fn):
+        if job.canceled.is_set():
+            # Canceled while waiting for a slot
+            return
 
-@app.route("/transcribe", methods=["POST"])
-def transcribe():
-    filename = request.json.get("filename")
-    model = request.json.get("model")
-    print(f"Transcribing: {filename} with {model}")
+        job.update(state="running", started=time.time())
+        try:
+            result = fn(job)
+            job.update(
+                state="finished", progress=100, result=result, finished=time.time()
+            )
+        except JobCanceled:
+            print(f"Job canceled: {job.id}")
+            job.update(state="canceled", finished=time.time())
+        except Exception as e:
+            app.logger.error(traceback.format_exc())
+            job.update(state="failed", error=str(e), finished=time.time())
+
+
+class ResultCache:
+    """
+    A persistent key/value cache in a SQLite table. Values are stored as JSON, and the least
+    recently used ones get evicted when the table grows past max_size bytes. SQLite handles
+    locking, so all of the web server's worker processes can share it.
+    """
+
+    def __init__(self, path, table, max_size):
+        self.path = path
+        self.table = table
+        self.max_size = max_size
+        self.local = threading.local()
+
+    def _connect(self):
+        # SQLite connections can't be shared between threads, so each thread gets its own
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} "
+                "(key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)"
+            )
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.table}_last_used "
+                f"ON {self.table} (last_used)"
+            )
+            connection.commit()
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        connection = self._connect()
+        row = connection.execute(
+            f"SELECT value FROM {self.table} WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+
+        with connection:
+            connection.execute(
+                f"UPDATE {self.table} SET last_used = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        return json.loads(row[0])
+
+    def get_many(self, keys):
+        # Returns a dict of the keys that were found and their values
+        connection = self._connect()
+        values = {}
+        keys = list(keys)
+        # Stay under SQLite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = connection.execute(
+                f"SELECT key, value FROM {self.table} WHERE key IN ({placeholders})",
+                chunk,
+            ).fetchall()
+            values.update((key, json.loads(value)) for key, value in rows)
+
+        if values:
+            with connection:
+                connection.executemany(
+                    f"UPDATE {self.table} SET last_used = ? WHERE key = ?",
+                    [(time.time(), key) for key in values],
+                )
+        return values
+
+    def put(self, key, value):
+        self.put_many({key: value})
+
+    def put_many(self, items):
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value)
+            rows.append((key, value, len(value), now))
+
+        connection = self._connect()
+        with connection:
+            connection.executemany(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?, ?)", rows
+            )
+            self._evict(connection)
+
+    def _evict(self, connection):
+        total_size = connection.execute(
+            f"SELECT COALESCE(SUM(size), 0) FROM {self.table}"
+        ).fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        rows = connection.execute(
+            f"SELECT key, size FROM {self.table} ORDER BY last_used"
+        ).fetchall()
+        evict = []
+        for key, size in rows:
+            if total_size <= self.max_size:
+                break
+            evict.append((key,))
+            total_size -= size
+        connection.executemany(f"DELETE FROM {self.table} WHERE key = ?", evict)
+
+
+class _FileHashes:
+    # Remembers file hashes, so the same file doesn't get hashed twice unless it changes
+    def __init__(self, size=256):
+        self.size = size
+        self.hashes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def hash(self, filename):
+        info = os.stat(filename)
+        key = (os.path.abspath(filename), info.st_size, info.st_mtime_ns)
+        with self.lock:
+            if key in self.hashes:
+                self.hashes.move_to_end(key)
+                return self.hashes[key]
+
+        hasher = hashlib.sha256()
+        with open(filename, "rb") as f:
+            while data := f.read(DOWNLOAD_CHUNK_SIZE):
+                hasher.update(data)
+
+        with self.lock:
+            self.hashes[key] = hasher.hexdigest()
+            if len(self.hashes) > self.size:
+                self.hashes.popitem(last=False)
+        return hasher.hexdigest()
+
+
+file_hashes = _FileHashes()
+
+
+class FeatureCache:
+    """
+    Decoded audio and its spectrograms, keyed by a hash of the audio file, so transcribing the
+    same file again, like with a bigger model, doesn't decode it again. Each audio file gets a
+    folder of .npy files, which are memory-mapped when they're loaded. The least recently used
+    folders get deleted when the cache grows past max_size bytes. Folders with a file still
+    being written are left alone.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+    def load(self, audio_hash, name):
+        with self.lock:
+            return self._load(audio_hash, name)
+
+    def _load(self, audio_hash, name):
+        # Called with the lock held
+        filename = os.path.join(self.directory, audio_hash, f"{name}.npy")
+        try:
+            # Copy-on-write, so changing the array doesn't change the file
+            array = np.load(filename, mmap_mode="c")
+        except FileNotFoundError:
+            return None
+
+        # The folder's modification time is when it was last used
+        os.utime(os.path.dirname(filename))
+        return array
+
+    def store(self, audio_hash, name, array):
+        directory = os.path.join(self.directory, audio_hash)
+        filename = os.path.join(directory, f"{name}.npy")
+        # Another thread might be storing the same file. The part file is created under the
+        # lock, so eviction sees it and keeps the folder while it's written.
+        part_filename = f"{filename}.{uuid.uuid4().hex}.part"
+        with self.lock:
+            os.makedirs(directory, exist_ok=True)
+            f = open(part_filename, "wb")
+        try:
+            with f:
+                np.save(f, array)
+            with self.lock:
+                os.replace(part_filename, filename)
+                self._evict(keep=audio_hash)
+                return self._load(audio_hash, name)
+        except BaseException:
+            with self.lock:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(part_filename)
+            raise
+
+    def _evict(self, keep):
+        # Called with the lock held
+        entries = []
+        total_size = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                filenames = os.listdir(entry.path)
+                size = sum(
+                    os.path.getsize(os.path.join(entry.path, filename))
+                    for filename in filenames
+                    if not filename.endswith(".part")
+                )
+                writing = any(filename.endswith(".part") for filename in filenames)
+                total_size += size
+                if entry.name != keep and not writing:
+                    entries.append((entry.stat().st_mtime, entry.name, size))
+
+        for _, name, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total_size -= size
+
+
+feature_cache = FeatureCache(get_feature_cache_dir(), get_feature_cache_size())
+
+
+# Files that make up each Helsinki NLP model
+helsinki_filenames = [
+    # tokenizer
+    "tokenizer_config.json",
+    "config.json",
+    "source.spm",
+    "target.spm",
+    "vocab.json",
+    # model
+    "pytorch_model.bin",
+    "generation_config.json",
+]
+helsinki_quantized_filename = "pytorch_model-int8.bin"
+
+# Models get converted to safetensors after they're downloaded, see convert_model(). It isn't
+# called model.safetensors, since transformers leaves some weights out of the ones it saves.
+helsinki_converted_filename = "converted.safetensors"
+
+
+class ModelCatalog:
+    """
+    Every model that can be downloaded, which files it's made of, and whether it's installed.
+    Install state is cached, and only looked up on disk again when the modification time of
+    one of the model directories changes, or after invalidate() is called.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stamp = None
+        self.state = {}
+
+        self._add(
+            "transcribe",
+            "speaker-diarization",
+            "Speaker diarization, required for transcription",
+            kind="pyannote",
+            directory=os.path.join(get_models_dir(), "pyannote"),
+            files=[
+                {
+                    "filename": "pytorch_model.bin",
+                    "url": "https://github.com/micahflee/neuronbox/releases/download/models/pytorch_model.bin",
+                    "expected_size": 6 * MB,
+                }
+            ],
+            ram=pyannote_ram_estimate,
+            delete_directory=True,
+        )
 
-    # Validate filename
-    try:
-        if not os.path.exists(filename):
-            return jsonify({"success": False, "error": "File does not exist"})
+        whisper_descriptions = {
+            "small": "Small, requires ~2GB RAM",
+            "medium": "Medium, requires ~5GB RAM",
+            "large": "Large, requires ~10GB RAM",
+        }
+        whisper_expected_sizes = {
+            "small": 461 * MB,
+            "medium": 1457 * MB,
+            "large": 2944 * MB,
+            "small-int8": 350 * MB,
+            "medium-int8": 900 * MB,
+            "large-int8": 1800 * MB,
+        }
+        for name, description in whisper_descriptions.items():
+            self._add(
+                "transcribe",
+                name,
+                description,
+                kind="whisper",
+                directory=os.path.join(get_models_dir(), "whisper"),
+                files=[
+                    {
+                        "filename": f"{name}.pt",
+                        # Looked up when downloading, since importing whisper is slow
+                        "url": lambda name=name: import_whisper()._MODELS[name],
+                        "expected_size": whisper_expected_sizes[name],
+                    }
+                ],
+                converted=[f"{name}.safetensors"],
+                ram=whisper_ram_estimates[name],
+                delete_directory=False,
+            )
 
-        if (
-            not filename.endswith(".wav")
-            and not filename.endswith(".mp3")
-            and not filename.endswith(".flac")
-            and not filename.endswith(".m4a")
-        ):
-            basename = os.path.basename(filename)
-            return jsonify(
-                {"success": False, "error": f"{basename} is not an audio file"}
+            # Quantized models are made from the original after it's downloaded
+            quantized_name = f"{name}{QUANTIZED_SUFFIX}"
+            self._add(
+                "transcribe",
+                quantized_name,
+                f"{description.split(',')[0]} int8, requires ~{whisper_ram_estimates[quantized_name] // GB}GB RAM, faster on CPU",
+                kind="whisper",
+                directory=os.path.join(get_models_dir(), "whisper"),
+                files=[
+                    {
+                        "filename": f"{quantized_name}.pt",
+                        "url": None,
+                        "expected_size": whisper_expected_sizes[quantized_name],
+                    }
+                ],
+                ram=whisper_ram_estimates[quantized_name],
+                delete_directory=False,
+                base=name,
             )
-    except Exception as e:
-        return jsonify({"success": False, "error": f"Invalid file: {e}"})
 
-    # Validate model, it should be either "small", "medium", or "large"
-    if model not in ["small", "medium", "large"]:
-        return jsonify({"success": False, "error": f"Invalid model: {model}"})
+        # Translate models (start with only target language English)
+        for language_code, language_name in language_codes.items():
+            # Skip English, since we don't translate from English to English
+            if language_code == "en":
+                continue
+
+            name = f"opus-mt-{language_code}-en"
+            base_url = f"https://huggingface.co/Helsinki-NLP/{name}/resolve/main"
+            self._add(
+                "translate",
+                name,
+                f"{language_name} to English",
+                kind="helsinki",
+                directory=os.path.join(get_models_dir(), "Helsinki-NLP", name),
+                files=[
+                    {
+                        "filename": filename,
+                        "url": f"{base_url}/{filename}",
+                        "expected_size": 300 * MB
+                        if filename == "pytorch_model.bin"
+                        else None,
+                    }
+                    for filename in helsinki_filenames
+                ],
+                converted=[helsinki_converted_filename],
+                ram=translate_ram_estimate,
+                delete_directory=True,
+            )
 
-    # Make sure the model is actually downloaded
-    if not os.path.exists(os.path.join(get_models_dir(), "whisper", f"{model}.pt")):
-        return jsonify(
-            {
-                "success": False,
-                "error": f'You must download the model "{model}" before you can use it',
-            }
-        )
+            # The quantized model shares the original's directory, tokenizer and config
+            self._add(
+                "translate",
+                f"{name}{QUANTIZED_SUFFIX}",
+                f"{language_name} to English (int8)",
+                kind="helsinki",
+                directory=os.path.join(get_models_dir(), "Helsinki-NLP", name),
+                files=[
+                    {
+                        "filename": helsinki_quantized_filename,
+                        "url": None,
+                        "expected_size": 150 * MB,
+                    }
+                ],
+                ram=translate_int8_ram_estimate,
+                delete_directory=False,
+                base=name,
+            )
 
-    transcription = do_transcribe(model, filename)
-    return jsonify(transcription)
+    def _add(self, feature, name, description, **fields):
+        self.entries[(feature, name)] = {
+            "feature": feature,
+            "name": name,
+            "description": description,
+            **fields,
+        }
 
+    def get(self, feature, name):
+        return self.entries.get((feature, name))
 
-# Translate
+    def list(self, feature):
+        return [entry for entry in self.entries.values() if entry["feature"] == feature]
 
+    def invalidate(self):
+        with self.lock:
+            self.stamp = None
 
-@app.route("/languages")
-def languages():
-    return jsonify(language_codes)
+    def _stamp(self):
+        # The modification times of the directories models get downloaded into. Adding or
+        # removing a file changes the modification time of its directory.
+        stamp = []
+        for directory in ["whisper", "pyannote", "Helsinki-NLP"]:
+            path = os.path.join(get_models_dir(), directory)
+            try:
+                stamp.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                stamp.append(None)
+                continue
+
+            if directory == "Helsinki-NLP":
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir():
+                            stamp.append((entry.name, entry.stat().st_mtime_ns))
+        return tuple(stamp)
+
+    def _refresh(self):
+        stamp = self._stamp()
+        with self.lock:
+            if stamp == self.stamp:
+                return self.state
+
+        state = {}
+        for key, entry in self.entries.items():
+            sizes = []
+            for file in entry["files"]:
+                try:
+                    sizes.append(
+                        os.path.getsize(
+                            os.path.join(entry["directory"], file["filename"])
+                        )
+                    )
+                except FileNotFoundError:
+                    sizes.append(None)
+            # Converted files take up disk space too, so they count towards the size
+            converted_size = 0
+            for filename in entry.get("converted", []):
+                try:
+                    converted_size += os.path.getsize(
+                        os.path.join(entry["directory"], filename)
+                    )
+                except FileNotFoundError:
+                    pass
+            state[key] = {
+                "downloaded": None not in sizes,
+                "size": sum(size for size in sizes if size is not None)
+                + converted_size,
+            }
 
+        with self.lock:
+            self.stamp = stamp
+            self.state = state
+        return state
+
+    def is_downloaded(self, entry):
+        return self._refresh()[(entry["feature"], entry["name"])]["downloaded"]
+
+    def to_dict(self, entry):
+        state = self._refresh()[(entry["feature"], entry["name"])]
+        return {
+            "name": entry["name"],
+            "description": entry["description"],
+            "downloaded": state["downloaded"],
+            "size": state["size"],
+            "expected_size": sum(file["expected_size"] or 0 for file in entry["files"]),
+            "ram": entry["ram"],
+            "quantized": "base" in entry,
+        }
 
-def do_translate(source_text, source_language, target_language="en"):
-    model_path = os.path.join(
-        get_models_dir(), "Helsinki-NLP", f"opus-mt-{source_language}-{target_language}"
-    )
 
-    print(f"Translating from {source_language} to {target_language}: {source_text}")
+# Create folders if they don't exist
 
-    start_time = time.time()
+for directory in ["whisper", "pyannote", "Helsinki-NLP"]:
+    if not os.path.exists(os.path.join(get_models_dir(), directory)):
+        os.makedirs(os.path.join(get_models_dir(), directory))
+os.makedirs(get_feature_cache_dir(), exist_ok=True)
 
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
-    model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
 
-    batch = tokenizer([source_text], return_tensors="pt")
+# Create the flask app
+
+app = Flask(__name__)
+CORS(app)  # TODO: restrict origins to just localhost
+
+
+@app.errorhandler(Exception)
+def handle_exception(e):
+    # Capture the stack trace
+    trace = traceback.format_exc()
+    # Log it, send it to an external service, etc.
+    app.logger.error(trace)
+    return str(e), 500
+
+
+@app.errorhandler(ServerBusy)
+def handle_server_busy(e):
+    # Tell the client when to try again, instead of making everyone slower
+    retry_after = math.ceil(e.retry_after)
+    response = jsonify(
+        {
+            "success": False,
+            "error": f"The server is busy, try again in about {retry_after} seconds",
+            "retry_after": retry_after,
+        }
+    )
+    response.headers["Retry-After"] = str(retry_after)
+    return response, 429
+
+
+def validate_priority(priority):
+    if priority not in PRIORITIES:
+        return f"Invalid priority: {priority}"
+    return None
+
+
+def validate_workers(workers):
+    if workers is None:
+        return None
+    if isinstance(workers, bool) or not isinstance(workers, int) or workers < 1:
+        return f"Invalid number of workers: {workers}"
+    return None
+
+
+class Warmup:
+    """
+    Imports the machine learning libraries, and loads models, in the background, so the first
+    request that needs them doesn't have to wait. Its progress shows up in /health.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = "idle"
+        self.ready = []
+        self.error = None
+
+    def start(self, entries):
+        with self.lock:
+            if self.state == "running":
+                return False
+            self.state = "running"
+            self.ready = []
+            self.error = None
+
+        threading.Thread(target=self._run, args=(entries,), daemon=True).start()
+        return True
+
+    def _run(self, entries):
+        steps = [
+            ("torch", lambda: __import__("torch")),
+            ("whisper", import_whisper),
+            ("pyannote", lambda: __import__("pyannote.audio")),
+            ("transformers", lambda: __import__("transformers")),
+        ]
+        for entry in entries:
+            steps.append((f"{entry['feature']}/{entry['name']}", self._loader(entry)))
+
+        try:
+            for name, step in steps:
+                print(f"Warming up: {name}")
+                step()
+                with self.lock:
+                    self.ready.append(name)
+        except Exception as e:
+            app.logger.error(traceback.format_exc())
+            with self.lock:
+                self.state = "failed"
+                self.error = str(e)
+            return
+
+        with self.lock:
+            self.state = "ready"
+
+    @staticmethod
+    def _loader(entry):
+        # Loads the model into loaded_models, under the same key the feature uses it with
+        name = entry["name"]
+        if entry["kind"] == "whisper":
+            key = f"whisper/{name}"
+            loader = lambda: load_whisper_model(name)
+        elif entry["kind"] == "pyannote":
+            key = "pyannote"
+            loader = load_pyannote_pipeline
+        else:
+            key = f"Helsinki-NLP/{name}"
+            loader = lambda: load_translate_model(entry["directory"], "base" in entry)
+
+        def load():
+            with loaded_models.use(key, loader, entry["ram"]):
+                pass
+
+        return load
+
+    def to_dict(self):
+        with self.lock:
+            return {"state": self.state, "ready": list(self.ready), "error": self.error}
+
+
+warmup = Warmup()
+
+
+# Health check
+@app.route("/health")
+def health():
+    # Not healthy until the model host is ready for work
+    if not model_host.is_available():
+        return jsonify({"status": "Starting"}), 503
+    return jsonify({"status": "OK", "warmup": model_host.call("warmup.status")})
+
+
+@app.route("/warmup", methods=["POST"])
+def warmup_start():
+    # Optionally takes lists of models to load, like {"transcribe": ["small"]}
+    options = request.get_json(silent=True) or {}
+    models = []
+    for feature in ["transcribe", "translate"]:
+        for model in options.get(feature, []):
+            entry = model_catalog.get(feature, model)
+            if entry is None:
+                return jsonify({"success": False, "error": f"Invalid model: {model}"})
+            if not model_catalog.is_downloaded(entry):
+                return jsonify(
+                    {
+                        "success": False,
+                        "error": f'You must download the model "{model}" before you can use it',
+                    }
+                )
+            models.append((feature, model))
+
+    print(f"Starting warmup: {models}")
+    started = model_host.call("warmup.start", models)
+    return jsonify(
+        {
+            "success": True,
+            "started": started,
+            "warmup": model_host.call("warmup.status"),
+        }
+    )
+
+
+# Models
+
+loaded_models = ModelRegistry(get_model_memory_budget(), get_model_idle_timeout())
+model_catalog = ModelCatalog()
+
+
+def load_whisper_model(model):
+    if model.endswith(QUANTIZED_SUFFIX):
+        return load_quantized_whisper_model(model)
+
+    # Models downloaded before they were converted get converted the first time they're used
+    filename = os.path.join(get_models_dir(), "whisper", f"{model}.safetensors")
+    if not os.path.exists(filename):
+        convert_whisper_model(model)
+    return load_mapped_whisper_model(model)
+
+
+# Downloaded models get converted to safetensors, so loading them can map the file into memory
+# instead of unpickling a copy of it. A cold load then reads straight from the page cache, and
+# processes that load the same model share the same physical memory.
+
+# safetensors names for torch dtypes
+safetensors_dtypes = {
+    "F64": "float64",
+    "F32": "float32",
+    "F16": "float16",
+    "BF16": "bfloat16",
+    "I64": "int64",
+    "I32": "int32",
+    "I16": "int16",
+    "I8": "int8",
+    "U8": "uint8",
+    "BOOL": "bool",
+}
+
+
+@contextlib.contextmanager
+def writing_part_file(filename):
+    # Yields a part file to write instead of filename, which replaces it once it's written. Each
+    # one has its own name, so converting the same model twice at the same time doesn't mix up
+    # the two files.
+    part_filename = f"{filename}.{uuid.uuid4().hex}.part"
+    try:
+        yield part_filename
+        os.replace(part_filename, filename)
+    finally:
+        _remove_files(part_filename)
+
+
+def save_safetensors(model, filename, metadata=None):
+    from safetensors.torch import save_model
+
+    # save_model() leaves out tensors that are shared with another one, like tied embeddings
+    with writing_part_file(filename) as part_filename:
+        save_model(model, part_filename, metadata)
+
+
+def map_safetensors(filename):
+    """
+    Map a safetensors file into memory, and return its tensors and metadata. The tensors are
+    views of the mapping, so nothing is read until it's used. It's mapped copy-on-write, so
+    changing a tensor doesn't change the file.
+    """
+    import torch
+
+    with open(filename, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    metadata = header.pop("__metadata__", None) or {}
+
+    storage = torch.UntypedStorage.from_file(
+        filename, shared=False, nbytes=os.path.getsize(filename)
+    )
+    data = torch.empty(0, dtype=torch.uint8).set_(storage)[8 + header_size :]
+
+    tensors = {}
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        dtype = getattr(torch, safetensors_dtypes[info["dtype"]])
+        view = data[begin:end]
+        if (8 + header_size + begin) % dtype.itemsize:
+            # Tensors are normally aligned, but if one isn't it has to be copied
+            view = view.clone()
+        tensors[name] = view.view(dtype).reshape(info["shape"])
+
+    # save_model() records the name of the tensor that each left out one was shared with
+    for name, shared_name in metadata.items():
+        if shared_name in tensors and name not in tensors:
+            tensors[name] = tensors[shared_name]
+    return tensors, metadata
+
+
+# Only one model can be built without random weights at a time, since it patches torch
+skip_weight_init_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def skip_weight_init():
+    import torch
+
+    names = ["uniform_", "normal_", "kaiming_uniform_", "kaiming_normal_"]
+    with skip_weight_init_lock:
+        originals = {name: getattr(torch.nn.init, name) for name in names}
+        for name in names:
+            setattr(torch.nn.init, name, lambda tensor, *args, **kwargs: tensor)
+        try:
+            yield
+        finally:
+            for name, original in originals.items():
+                setattr(torch.nn.init, name, original)
+
+
+def check_materialized(model):
+    # Models are built on the meta device and then given the mapped tensors, so anything
+    # still on the meta device wasn't in the file
+    for name, tensor in itertools.chain(
+        model.named_parameters(), model.named_buffers()
+    ):
+        if tensor.device.type == "meta":
+            raise RuntimeError(f"Converted model is missing {name}")
+
+
+def convert_whisper_model(model):
+    # Saves a downloaded whisper model as <model>.safetensors, with its dimensions
+    whisper = import_whisper()
+    whisper_model = whisper.load_model(
+        model, device="cpu", download_root=os.path.join(get_models_dir(), "whisper")
+    )
+    save_safetensors(
+        whisper_model,
+        os.path.join(get_models_dir(), "whisper", f"{model}.safetensors"),
+        {"dims": json.dumps(whisper_model.dims.__dict__)},
+    )
+
+
+def load_mapped_whisper_model(model):
+    import torch
+
+    whisper = import_whisper()
+    tensors, metadata = map_safetensors(
+        os.path.join(get_models_dir(), "whisper", f"{model}.safetensors")
+    )
+    dims = whisper.model.ModelDimensions(**json.loads(metadata["dims"]))
+
+    # Whisper can't be built on the meta device, since it makes a sparse tensor when it's built.
+    # Building it without random weights means their memory never gets touched before it's
+    # replaced with the mapped weights.
+    with skip_weight_init():
+        whisper_model = whisper.model.Whisper(dims)
+    whisper_model.load_state_dict(tensors, assign=True)
+    whisper_model.set_alignment_heads(whisper._ALIGNMENT_HEADS[model])
+
+    if torch.cuda.is_available():
+        whisper_model = whisper_model.to("cuda")
+    whisper_model.eval()
+    return whisper_model
+
+
+def quantize_linear_layers(model):
+    # Dynamic int8 quantization of the linear layers, for faster inference on CPU. Whisper uses
+    # its own subclass of nn.Linear, which quantize_dynamic doesn't recognize, so make them
+    # plain nn.Linear layers first.
+    import torch
+
+    for module in model.modules():
+        if isinstance(module, torch.nn.Linear):
+            module.__class__ = torch.nn.Linear
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def quantize_whisper_model(model):
+    # Quantizes a downloaded whisper model, and saves it as <model>-int8.pt
+    import torch
+
+    whisper = import_whisper()
+    whisper_model = whisper.load_model(
+        model, device="cpu", download_root=os.path.join(get_models_dir(), "whisper")
+    )
+    whisper_model = quantize_linear_layers(whisper_model)
+
+    filename = os.path.join(
+        get_models_dir(), "whisper", f"{model}{QUANTIZED_SUFFIX}.pt"
+    )
+    with writing_part_file(filename) as part_filename:
+        torch.save(
+            {
+                "dims": whisper_model.dims.__dict__,
+                "model_state_dict": whisper_model.state_dict(),
+            },
+            part_filename,
+        )
+
+
+def load_quantized_whisper_model(model):
+    import torch
+
+    whisper = import_whisper()
+    filename = os.path.join(get_models_dir(), "whisper", f"{model}.pt")
+    checkpoint = torch.load(filename, map_location="cpu", weights_only=False)
+
+    # Build an empty model with the same quantized layers, then fill in the saved weights
+    whisper_model = whisper.model.Whisper(
+        whisper.model.ModelDimensions(**checkpoint["dims"])
+    )
+    whisper_model = quantize_linear_layers(whisper_model)
+    whisper_model.load_state_dict(checkpoint["model_state_dict"])
+
+    alignment_heads = whisper._ALIGNMENT_HEADS.get(model[: -len(QUANTIZED_SUFFIX)])
+    if alignment_heads:
+        whisper_model.set_alignment_heads(alignment_heads)
+    whisper_model.eval()
+    return whisper_model
+
+
+def quantize_translate_model(model_path):
+    # Quantizes a downloaded Helsinki NLP model, and saves it next to the original
+    import torch
+    from transformers import AutoModelForSeq2SeqLM
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+    model = quantize_linear_layers(model)
+
+    filename = os.path.join(model_path, helsinki_quantized_filename)
+    with writing_part_file(filename) as part_filename:
+        torch.save(model.state_dict(), part_filename)
+
+
+def convert_translate_model(model_path):
+    # Saves a downloaded Helsinki NLP model as converted.safetensors, next to the original
+    from transformers import AutoModelForSeq2SeqLM
+
+    model = AutoModelForSeq2SeqLM.from_pretrained(model_path)
+    save_safetensors(model, os.path.join(model_path, helsinki_converted_filename))
+
+
+def load_mapped_translate_model(model_path):
+    import torch
+    from transformers import AutoConfig, AutoModelForSeq2SeqLM
+
+    tensors, _ = map_safetensors(os.path.join(model_path, helsinki_converted_filename))
+    with torch.device("meta"):
+        model = AutoModelForSeq2SeqLM.from_config(
+            AutoConfig.from_pretrained(model_path)
+        )
+    # Tied weights get loaded as separate parameters, so tie them together again
+    model.load_state_dict(tensors, assign=True, strict=False)
+    model.tie_weights()
+    check_materialized(model)
+    load_generation_config(model, model_path)
+    return model
+
+
+def load_generation_config(model, model_path):
+    # from_config only derives generation settings from config.json, so apply the downloaded
+    # generation_config.json (beam count, maximum length) like from_pretrained would
+    from transformers import GenerationConfig
+
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(model_path)
+    except OSError:
+        # Older models don't have one, and keep the settings from config.json
+        pass
+
+
+def convert_model(entry):
+    print(f"Converting: {entry['name']}")
+    if entry["kind"] == "whisper":
+        convert_whisper_model(entry["name"])
+    elif entry["kind"] == "helsinki":
+        convert_translate_model(entry["directory"])
+
+
+def quantize_model(entry):
+    print(f"Quantizing: {entry['base']}")
+    if entry["kind"] == "whisper":
+        quantize_whisper_model(entry["base"])
+    elif entry["kind"] == "helsinki":
+        quantize_translate_model(entry["directory"])
+
+
+class DownloadError(Exception):
+    pass
+
+
+class DownloadCanceled(Exception):
+    pass
+
+
+def get_expected_sha256(download_url):
+    # Whisper model URLs include the SHA-256 of the file, like .../models/<sha256>/small.pt
+    parts = download_url.split("/")
+    if len(parts) >= 2 and re.fullmatch(r"[0-9a-f]{64}", parts[-2]):
+        return parts[-2]
+    return None
+
+
+class _PieceHasher:
+    """
+    Hashes pieces of a file in order as they finish downloading, even though parallel
+    connections can finish them out of order. Pieces that arrive early wait in memory until
+    the ones before them are hashed.
+    """
+
+    def __init__(self, hasher, first_piece, on_hashed):
+        self.hasher = hasher
+        self.next_piece = first_piece
+        self.on_hashed = on_hashed
+        self.waiting = {}
+        self.changed = threading.Condition()
+
+    def add(self, index, data):
+        with self.changed:
+            self.waiting[index] = data
+            while self.next_piece in self.waiting:
+                data = self.waiting.pop(self.next_piece)
+                self.hasher.update(data)
+                self.next_piece += 1
+                self.on_hashed(self.next_piece)
+            self.changed.notify_all()
+
+    def wait_for_room(self, index, max_ahead, is_stopped):
+        # Don't let connections get too far ahead of the hasher, so memory stays bounded
+        with self.changed:
+            while index >= self.next_piece + max_ahead and not is_stopped():
+                self.changed.wait(1)
+
+
+def _remove_files(*filenames):
+    for filename in filenames:
+        try:
+            os.remove(filename)
+        except FileNotFoundError:
+            pass
+
+
+class FileDownload:
+    """
+    Downloads a file, resuming from a partial download if there is one. If the server supports
+    range requests, large files are fetched over several connections at once. The SHA-256 is
+    computed while the data streams in, and checked against expected_sha256 if it's known.
+
+    run() raises DownloadCanceled if is_canceled() returns True, and DownloadError or a
+    requests exception if the download fails. After a failure the partial download is kept,
+    so the next attempt can resume it.
+    """
+
+    def __init__(
+        self,
+        download_url,
+        filename,
+        expected_sha256=None,
+        on_progress=None,
+        is_canceled=None,
+        connections=DOWNLOAD_CONNECTIONS,
+    ):
+        self.download_url = download_url
+        self.filename = filename
+        self.expected_sha256 = expected_sha256
+        self.on_progress = on_progress or (lambda done, total: None)
+        self.is_canceled = is_canceled or (lambda: False)
+        self.connections = connections
+
+        self.part_filename = f"{filename}.part"
+        # When pieces are downloaded in parallel, the .part file can have holes, so this keeps
+        # track of how much of it is complete
+        self.resume_filename = f"{filename}.part.resume"
+
+        self.offset = 0
+        self.total_size = None
+        self.hasher = hashlib.sha256()
+
+    def run(self):
+        self._resume()
+
+        session = requests.Session()
+        try:
+            self._fetch(session)
+        except DownloadCanceled:
+            _remove_files(self.part_filename, self.resume_filename)
+            raise
+        finally:
+            session.close()
+
+        if (
+            self.total_size is not None
+            and os.path.getsize(self.part_filename) != self.total_size
+        ):
+            _remove_files(self.part_filename, self.resume_filename)
+            raise DownloadError("Downloaded data size does not match expected size")
+
+        if self.expected_sha256 and self.hasher.hexdigest() != self.expected_sha256:
+            _remove_files(self.part_filename, self.resume_filename)
+            raise DownloadError(
+                "Downloaded file does not match the expected SHA-256 checksum"
+            )
+
+        os.replace(self.part_filename, self.filename)
+        _remove_files(self.resume_filename)
+        return self.hasher.hexdigest()
+
+    def _resume(self):
+        # Figure out how much we already have, and hash it so we can keep hashing from there
+        offset = 0
+        if os.path.exists(self.part_filename):
+            offset = os.path.getsize(self.part_filename)
+        if os.path.exists(self.resume_filename):
+            with open(self.resume_filename) as f:
+                try:
+                    offset = min(offset, int(f.read()))
+                except ValueError:
+                    offset = 0
+
+        self._restart(offset)
+        if offset:
+            print(f"Resuming download of {self.filename} at {offset} bytes")
+            with open(self.part_filename, "rb") as f:
+                while f.tell() < offset:
+                    self.hasher.update(
+                        f.read(min(DOWNLOAD_CHUNK_SIZE, offset - f.tell()))
+                    )
+        self.offset = offset
+
+    def _restart(self, offset):
+        # Throw away anything after offset
+        with open(self.part_filename, "ab") as f:
+            f.truncate(offset)
+        _remove_files(self.resume_filename)
+        if offset == 0:
+            self.hasher = hashlib.sha256()
+        self.offset = offset
+
+    def _fetch(self, session):
+        # Streams the rest of the file over one connection, retrying from where it left off
+        # when the connection drops. If the server supports ranges and there's a lot left,
+        # hands off to _fetch_parallel instead.
+        attempt = 0
+        while True:
+            headers = {"Range": f"bytes={self.offset}-"} if self.offset else {}
+            try:
+                with session.get(self.download_url, stream=True, headers=headers) as r:
+                    if r.status_code == 416:
+                        # We already have the whole file
+                        self.total_size = self.offset
+                        return
+                    r.raise_for_status()
+
+                    if r.status_code == 206:
+                        content_range = r.headers.get("content-range", "")
+                        self.total_size = int(content_range.split("/")[-1])
+                        supports_ranges = True
+                    else:
+                        # The server ignored the range, so start over
+                        self._restart(0)
+                        self.total_size = (
+                            int(r.headers.get("content-length", 0)) or None
+                        )
+                        supports_ranges = r.headers.get("accept-ranges") == "bytes"
+
+                    remaining = (self.total_size or 0) - self.offset
+                    if (
+                        supports_ranges
+                        and self.connections > 1
+                        and remaining > 2 * DOWNLOAD_PIECE_SIZE
+                    ):
+                        r.close()
+                        self._fetch_parallel()
+                        return
+
+                    with open(self.part_filename, "ab") as f:
+                        for data in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                            if self.is_canceled():
+                                raise DownloadCanceled()
+                            f.write(data)
+                            self.hasher.update(data)
+                            self.offset += len(data)
+                            self.on_progress(self.offset, self.total_size)
+                    return
+
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                attempt += 1
+                if attempt > DOWNLOAD_RETRIES:
+                    raise
+                print(f"Download interrupted ({e}), retrying from {self.offset} bytes")
+                time.sleep(2**attempt)
+
+    def _piece_range(self, index):
+        # The first piece might start partway through, if we're resuming
+        start = max(index * DOWNLOAD_PIECE_SIZE, self.offset)
+        end = min((index + 1) * DOWNLOAD_PIECE_SIZE, self.total_size)
+        return start, end
+
+    def _fetch_parallel(self):
+        first_piece = self.offset // DOWNLOAD_PIECE_SIZE
+        piece_count = -(-self.total_size // DOWNLOAD_PIECE_SIZE)
+        lock = threading.Lock()
+        next_piece = [first_piece]
+        done = [self.offset]
+        errors = []
+
+        def on_hashed(hashed_pieces):
+            with open(self.resume_filename, "w") as f:
+                f.write(str(self._piece_range(hashed_pieces - 1)[1]))
+
+        pieces = _PieceHasher(self.hasher, first_piece, on_hashed)
+
+        def stopped():
+            return bool(errors) or self.is_canceled()
+
+        def work():
+            session = requests.Session()
+            try:
+                with open(self.part_filename, "r+b") as f:
+                    while not stopped():
+                        with lock:
+                            index = next_piece[0]
+                            if index >= piece_count:
+                                return
+                            next_piece[0] += 1
+
+                        pieces.wait_for_room(index, 2 * self.connections, stopped)
+                        start, end = self._piece_range(index)
+                        data = self._fetch_piece(session, start, end, stopped)
+                        if data is None:
+                            return
+
+                        f.seek(start)
+                        f.write(data)
+                        f.flush()
+                        pieces.add(index, data)
+                        with lock:
+                            done[0] += len(data)
+                            self.on_progress(done[0], self.total_size)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                session.close()
+
+        with open(self.part_filename, "r+b") as f:
+            f.truncate(self.total_size)
+
+        threads = [threading.Thread(target=work) for _ in range(self.connections)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.is_canceled():
+            raise DownloadCanceled()
+
+        if errors:
+            # Only keep what was hashed, so retrying can pick up from there
+            if pieces.next_piece < piece_count:
+                self._restart(self._piece_range(pieces.next_piece)[0])
+            raise errors[0]
+
+        self.offset = self.total_size
+
+    def _fetch_piece(self, session, start, end, stopped):
+        data = bytearray()
+        attempt = 0
+        while True:
+            headers = {"Range": f"bytes={start + len(data)}-{end - 1}"}
+            try:
+                with session.get(self.download_url, stream=True, headers=headers) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        raise DownloadError(
+                            "The server stopped supporting range requests"
+                        )
+                    for chunk in r.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        if stopped():
+                            return None
+                        data += chunk
+                if len(data) != end - start:
+                    raise requests.ConnectionError("Incomplete range response")
+                return bytes(data)
+
+            except (
+                requests.ConnectionError,
+                requests.Timeout,
+                requests.exceptions.ChunkedEncodingError,
+            ) as e:
+                attempt += 1
+                if attempt > DOWNLOAD_RETRIES:
+                    raise
+                print(f"Download of bytes {start}-{end} interrupted ({e}), retrying")
+                time.sleep(2**attempt)
+
+
+def download(download_url, filename, status, model, expected_sha256=None, timings=None):
+    # status is the DownloadStatus of the whole model, which the caller cleans up once every
+    # file has been downloaded
+    timings = timings or Timings()
+    progress = tqdm(unit="B", unit_scale=True, desc=model)
+
+    def on_progress(done, total):
+        progress.total = total
+        progress.update(done - progress.n)
+        if total:
+            status.update(done / total * 100)
+
+    try:
+        with timings.stage("download"):
+            FileDownload(
+                download_url,
+                filename,
+                expected_sha256=expected_sha256,
+                on_progress=on_progress,
+                is_canceled=status.is_canceled,
+            ).run()
+        metrics.increment("download_bytes_total", os.path.getsize(filename))
+
+    except DownloadCanceled:
+        print("Canceled download detected, deleted partial model")
+        return jsonify({"success": True, "canceled": True})
+
+    except (
+        DownloadError,
+        requests.ConnectionError,
+        requests.Timeout,
+        requests.RequestException,
+    ) as e:
+        # Specific error handling for each exception type
+        if isinstance(e, DownloadError):
+            error_message = str(e)
+        elif isinstance(e, requests.ConnectionError):
+            error_message = "Failed to establish a connection. Please check your internet connection."
+        elif isinstance(e, requests.Timeout):
+            error_message = "The request timed out. Please try again later."
+        else:
+            error_message = f"An error occurred while downloading: {str(e)}"
+
+        print(f"Error: {error_message}")
+        return jsonify(
+            {
+                "success": False,
+                "error": error_message,
+            }
+        )
+
+    finally:
+        progress.close()
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return app.response_class(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/models")
+def models():
+    return jsonify(
+        {
+            "models": {
+                "transcribe": [
+                    model_catalog.to_dict(entry)
+                    for entry in model_catalog.list("transcribe")
+                ],
+                "translate": [
+                    model_catalog.to_dict(entry)
+                    for entry in model_catalog.list("translate")
+                ],
+            }
+        }
+    )
+
+
+@app.route("/models/loaded")
+def models_loaded():
+    return jsonify(model_host.call("models.loaded"))
+
+
+@app.route("/models/download", methods=["POST"])
+def models_download():
+    feature = request.json.get("feature")
+    model = request.json.get("model")
+    key = f"{feature}_{model}"
+    print(f"Starting download: {key}")
+
+    if feature not in ["transcribe", "translate"]:
+        return jsonify({"success": False, "error": f"Invalid feature: {feature}"})
+
+    entry = model_catalog.get(feature, model)
+    if entry is None:
+        return jsonify({"success": False, "error": f"Invalid model: {model}"})
+
+    # Held until every file is downloaded, so a cancel between files isn't lost
+    status = DownloadStatus.claim(key)
+    if status is None:
+        return jsonify(
+            {"success": False, "error": f'"{model}" is already being downloaded'}
+        )
+    try:
+        return download_model(feature, model, entry, status)
+    finally:
+        status.clean()
+
+
+def download_model(feature, model, entry, status):
+    key = status.key
+
+    if not os.path.exists(entry["directory"]):
+        os.makedirs(entry["directory"])
+
+    if entry["kind"] == "pyannote":
+        filename = os.path.join(entry["directory"], "pytorch_model.bin")
+
+        # While we're at it, go ahead and manually create the config.yaml instead of downloading
+        config_filename = os.path.join(entry["directory"], "config.yaml")
+        if not os.path.exists(config_filename):
+            with open(config_filename, "w") as f:
+                f.write(
+                    f"""pipeline:
+  name: pyannote.audio.pipelines.VoiceActivityDetection
+  params:
+    segmentation: {filename}
+
+params:
+  min_duration_off: 0.09791355693027545
+  min_duration_on: 0.05537587440407595
+  offset: 0.4806866463041527
+  onset: 0.8104268538848918"""
+                )
+
+    timings = Timings()
+    downloaded_bytes = 0
+
+    # Quantized models are made from the original, so download that first
+    sources = [entry]
+    if "base" in entry:
+        base = model_catalog.get(feature, entry["base"])
+        if not model_catalog.is_downloaded(base):
+            sources.insert(0, base)
+
+    try:
+        for file in [file for source in sources for file in source["files"]]:
+            if file["url"] is None:
+                continue
+
+            download_url = file["url"]
+            if callable(download_url):
+                download_url = download_url()
+            filename = os.path.join(entry["directory"], file["filename"])
+
+            if status.is_canceled():
+                print("Canceled download detected")
+                return jsonify({"success": True, "canceled": True})
+
+            print(f"Key: {key}: Downloading {download_url} to {filename}")
+            ret = download(
+                download_url,
+                filename,
+                status,
+                model,
+                get_expected_sha256(download_url),
+                timings,
+            )
+            if ret != None:
+                return ret
+            downloaded_bytes += os.path.getsize(filename)
+
+        # Converting and quantizing load the whole model, so do it where the models are
+        for source in sources:
+            if "converted" in source:
+                with timings.stage("convert"):
+                    model_host.call("models.convert", feature, source["name"])
+        if "base" in entry:
+            with timings.stage("quantize"):
+                model_host.call("models.quantize", feature, model)
+    finally:
+        model_catalog.invalidate()
+
+    download_time = timings.to_dict().get("download")
+    return jsonify(
+        {
+            "success": True,
+            "timings": timings.to_dict(),
+            "download_bytes": downloaded_bytes,
+            "download_mb_per_second": downloaded_bytes / MB / download_time
+            if download_time
+            else None,
+        }
+    )
+
+
+@app.route("/download-progress/<feature>/<model>")
+def download_progress_route(feature, model):
+    def generate():
+        key = f"{feature}_{model}"
+        version = None
+        last_sent = 0
+        while True:
+            # Only send an event when the progress changes, or to keep the connection alive
+            status = download_progress.get(key)
+            progress, new_version = (status[0], status[1]) if status else (0, None)
+            if new_version != version or time.monotonic() - last_sent > 15:
+                version = new_version
+                last_sent = time.monotonic()
+                yield f"data:{progress}\n\n"
+            time.sleep(0.1)
+
+    response = app.response_class(
+        stream_with_context(generate()), mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Connection"] = "keep-alive"
+    return response
+
+
+@app.route("/models/cancel-download", methods=["POST"])
+def cancel_download():
+    feature = request.json.get("feature")
+    model = request.json.get("model")
+    key = f"{feature}_{model}"
+    print(f"Canceling download: {key}")
+
+    download_progress.cancel(key)
+
+    return jsonify({"success": True}), 200
+
+
+@app.route("/models/delete", methods=["POST"])
+def models_delete():
+    feature = request.json.get("feature")
+    model = request.json.get("model")
+    print(f"Deleting model: {feature} {model}")
+
+    if feature not in ["transcribe", "translate"]:
+        return jsonify({"success": False, "error": f"Invalid feature: {feature}"})
+
+    entry = model_catalog.get(feature, model)
+    if entry is None:
+        return jsonify({"success": False, "error": f"Invalid model: {model}"})
+
+    if entry["delete_directory"]:
+        print(f"Deleting {entry['directory']}")
+        shutil.rmtree(entry["directory"], ignore_errors=True)
+    else:
+        filenames = [file["filename"] for file in entry["files"]]
+        for filename in filenames + entry.get("converted", []):
+            filename = os.path.join(entry["directory"], filename)
+            print(f"Deleting {filename}")
+
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+
+    model_catalog.invalidate()
+    return jsonify({"success": True}), 200
+
+
+# Transcribe
+
+
+audio_extensions = (".wav", ".mp3", ".flac", ".m4a")
+
+# Matches the duration line that ffmpeg prints about its input, like "Duration: 00:01:23.45"
+duration_re = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)")
+
+
+def get_audio_duration(filename):
+    # ffmpeg without an output file prints information about the input and exits
+    process = subprocess.run(
+        [get_ffmpeg_path(), "-hide_banner", "-nostdin", "-i", filename],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    match = duration_re.search(process.stderr.decode(errors="replace"))
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def decode_audio(filename, read_size=4 * MB):
+    """
+    Decode any audio file into 16 kHz mono float32 PCM in memory, by piping it out of ffmpeg.
+    The samples are read straight into a single buffer in fixed size reads, so long recordings
+    never need more memory than the decoded audio itself.
+    """
+    duration = get_audio_duration(filename)
+
+    # Leave a little room in case the reported duration is slightly off
+    capacity = int((duration or 60) * SAMPLE_RATE * 1.01) + SAMPLE_RATE
+    audio = np.empty(capacity, dtype=np.float32)
+    buffer = memoryview(audio).cast("B")
+    size = 0
+
+    process = subprocess.Popen(
+        [
+            get_ffmpeg_path(),
+            "-hide_banner",
+            "-nostdin",
+            "-loglevel",
+            "error",
+            "-threads",
+            "0",
+            "-i",
+            filename,
+            "-f",
+            "f32le",
+            "-ac",
+            "1",
+            "-ar",
+            str(SAMPLE_RATE),
+            "-",
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    try:
+        while True:
+            if size == len(buffer):
+                audio = np.resize(audio, len(audio) * 2)
+                buffer = memoryview(audio).cast("B")
+
+            n = process.stdout.readinto(buffer[size : size + read_size])
+            if not n:
+                break
+            size += n
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        process.wait()
+
+    if process.returncode != 0:
+        raise RuntimeError(
+            f"Failed to decode {os.path.basename(filename)}: {stderr.decode(errors='replace').strip()}"
+        )
+
+    samples = size // audio.itemsize
+
+    # If the duration was unknown, don't hang on to a buffer that's much bigger than the audio
+    if samples < len(audio) * 0.75:
+        return audio[:samples].copy()
+    return audio[:samples]
+
+
+def load_audio(filename, timings=None):
+    # Decoded audio from the feature cache, or decode it and add it
+    timings = timings or Timings()
+    audio_hash = file_hashes.hash(filename)
+    audio = feature_cache.load(audio_hash, "audio")
+    if audio is not None:
+        metrics.increment("feature_cache_hits_total")
+        return audio_hash, audio
+
+    with timings.stage("decode"):
+        audio = decode_audio(filename)
+    return audio_hash, feature_cache.store(audio_hash, "audio", audio)
+
+
+# The AudioFeatures whisper should take spectrograms from, in the thread that's transcribing
+audio_features = threading.local()
+
+
+class AudioFeatures:
+    """
+    The log-mel spectrogram of a whole recording, computed once and kept in the feature cache,
+    for whisper to take each window's spectrogram from instead of computing it again. Windows
+    have to start on a frame boundary. The few frames at the edges of a window depend on
+    whisper's padding rather than the audio around the window, so only those get computed again.
+    """
+
+    def __init__(self, audio_hash, audio, timings=None):
+        self.audio_hash = audio_hash
+        self.audio = audio
+        self.timings = timings or Timings()
+        self.log_mels = {}
+
+    @contextlib.contextmanager
+    def use(self):
+        previous = getattr(audio_features, "current", None)
+        audio_features.current = self
+        try:
+            yield
+        finally:
+            audio_features.current = previous
+
+    def log_mel(self, n_mels):
+        import torch
+
+        if n_mels not in self.log_mels:
+            name = f"mel{n_mels}"
+            log_mel = feature_cache.load(self.audio_hash, name)
+            if log_mel is not None:
+                metrics.increment("feature_cache_hits_total")
+            else:
+                with self.timings.stage("mel"):
+                    log_mel = compute_log_mel(self.audio, n_mels)
+                log_mel = feature_cache.store(self.audio_hash, name, log_mel)
+            self.log_mels[n_mels] = torch.from_numpy(log_mel)
+        return self.log_mels[n_mels]
+
+    def window_log_mel(self, audio, n_mels, padding):
+        # What whisper's log_mel_spectrogram(audio, n_mels, padding) would return, if audio is
+        # part of this recording, or None
+        import torch
+
+        whisper = import_whisper()
+        n_fft = whisper.audio.N_FFT
+        hop_length = whisper.audio.HOP_LENGTH
+        if (
+            not isinstance(audio, np.ndarray)
+            or audio.dtype != np.float32
+            or not audio.flags.c_contiguous
+            or padding % hop_length
+            or len(self.audio) < whisper.audio.N_FFT
+        ):
+            return None
+        offset = (
+            audio.__array_interface__["data"][0]
+            - self.audio.__array_interface__["data"][0]
+        )
+        if offset < 0 or offset % (hop_length * audio.itemsize):
+            return None
+        start = offset // audio.itemsize // hop_length
+        frames = len(audio) // hop_length
+        log_mel = self.log_mel(n_mels)
+        if start + frames > log_mel.shape[1] or len(audio) + padding <= n_fft:
+            return None
+
+        # The padding is silence, which is the lowest value log_mel_spectrogram clamps to
+        log_spec = torch.cat(
+            [
+                log_mel[:, start : start + frames],
+                torch.full((n_mels, padding // hop_length), -10.0),
+            ],
+            dim=1,
+        )
+
+        # Frames that reach before the start of the window, or past the end of its audio, see
+        # whisper's reflection and silence instead of the rest of the recording
+        total_frames = log_spec.shape[1]
+        head_end = min(total_frames, -(-(n_fft // 2) // hop_length))
+        tail_start = max(0, (len(audio) - n_fft // 2) // hop_length + 1)
+        tail_end = total_frames
+        if padding >= n_fft:
+            # Further on, the frames only see silence
+            tail_end = min(total_frames, -(-(len(audio) + n_fft // 2) // hop_length))
+        # A few frames at a time, since a single frame goes through a matrix-vector product
+        # that rounds differently from whisper's matrix product
+        edges = [
+            (0, min(total_frames, max(head_end, 4))),
+            (max(0, min(tail_start, tail_end - 4)), tail_end),
+        ]
+        for first, last in edges:
+            if first < last:
+                log_spec[:, first:last] = window_edge_log_mel(
+                    audio, padding, first, last, n_mels
+                )
+
+        log_spec = torch.maximum(log_spec, log_spec.max() - 8.0)
+        return (log_spec + 4.0) / 4.0
+
+
+def compute_log_mel(audio, n_mels, block_frames=30000):
+    """
+    whisper's log_mel_spectrogram for a whole recording, before the normalization that depends
+    on which part of it is transcribed. It's computed a block of frames at a time, so a long
+    recording's short-time Fourier transform doesn't have to fit in memory all at once.
+    """
+    whisper = import_whisper()
+    n_fft = whisper.audio.N_FFT
+    hop_length = whisper.audio.HOP_LENGTH
+
+    # Frame i is centered on sample i * hop_length, and the recording is reflected at its ends,
+    # like torch.stft(center=True). whisper drops the last frame.
+    frames = len(audio) // hop_length
+    log_mel = np.empty((n_mels, frames), dtype=np.float32)
+    for first in range(0, frames, block_frames):
+        last = min(frames, first + block_frames)
+        start = first * hop_length - n_fft // 2
+        end = (last - 1) * hop_length + n_fft // 2
+        block = np.asarray(audio[max(0, start) : min(len(audio), end)])
+        block = np.pad(
+            block, (max(0, -start), max(0, end - len(audio))), mode="reflect"
+        )
+        log_mel[:, first:last] = frames_log_mel(block, n_mels).numpy()
+    return log_mel
+
+
+def window_edge_log_mel(audio, padding, first, last, n_mels):
+    # Frames first to last of whisper's log_mel_spectrogram(audio, n_mels, padding), before
+    # normalization: the audio is followed by padding of silence, and reflected at both ends
+    whisper = import_whisper()
+    n_fft = whisper.audio.N_FFT
+    hop_length = whisper.audio.HOP_LENGTH
+
+    length = len(audio) + padding
+    positions = np.abs(
+        np.arange(first * hop_length - n_fft // 2, (last - 1) * hop_length + n_fft // 2)
+    )
+    positions = np.where(positions >= length, 2 * (length - 1) - positions, positions)
+    samples = np.where(
+        positions < len(audio), audio[np.minimum(positions, len(audio) - 1)], 0
+    )
+    return frames_log_mel(samples.astype(np.float32), n_mels)
+
+
+def frames_log_mel(samples, n_mels):
+    # whisper's log-mel of each n_fft samples, hop_length apart, without padding
+    import torch
+
+    whisper = import_whisper()
+    stft = torch.stft(
+        torch.from_numpy(samples),
+        whisper.audio.N_FFT,
+        whisper.audio.HOP_LENGTH,
+        window=torch.hann_window(whisper.audio.N_FFT),
+        center=False,
+        return_complex=True,
+    )
+    mel = whisper.audio.mel_filters("cpu", n_mels) @ (stft.abs() ** 2)
+    return torch.clamp(mel, min=1e-10).log10()
+
+
+def iter_transcribe_segments(whisper_model, audio, window_seconds, features=None):
+    """
+    Transcribe audio one window at a time, yielding segments with timestamps relative to the
+    start of the audio. The last segment of each window might be cut off, so it gets transcribed
+    again at the start of the next window, the same way whisper seeks within a file.
+    """
+    window = int(window_seconds * SAMPLE_RATE)
+    seek = 0
+    language = None
+    prompt = None
+
+    while seek < len(audio):
+        cpu_scheduler.refresh()
+        end = min(seek + window, len(audio))
+        with features.use() if features else contextlib.nullcontext():
+            result = whisper_model.transcribe(
+                audio[seek:end], language=language, initial_prompt=prompt
+            )
+        language = result["language"]
+        segments = result["segments"]
+
+        next_seek = end
+        if end < len(audio) and len(segments) > 1:
+            # Timestamps are in steps of 20 ms. Rounding them to 10 ms starts the next
+            # window on a spectrogram frame, so it can use the cached spectrogram.
+            next_seek = seek + round(segments[-1]["start"] * 100) * SAMPLE_RATE // 100
+            segments = segments[:-1]
+            if next_seek <= seek:
+                next_seek = end
+
+        offset = seek / SAMPLE_RATE
+        for segment in segments:
+            yield {
+                "start": offset + segment["start"],
+                "end": offset + segment["end"],
+                "text": segment["text"],
+            }
+
+        # Condition the next window on the end of this one
+        if segments:
+            prompt = "".join(segment["text"] for segment in segments)[-200:]
+        seek = next_seek
+
+
+def find_quiet_splits(audio, chunk_seconds, search_seconds=10):
+    """
+    Pick places to split audio into chunks of about chunk_seconds, moving each split to the
+    quietest 100 ms within search_seconds of it, so splits land between words. Returns the
+    sample offsets of the chunk boundaries, including the start and end of the audio.
+    """
+    frame = SAMPLE_RATE // 10
+    frames = len(audio) // frame
+    energy = np.sqrt(
+        np.mean(audio[: frames * frame].reshape(frames, frame) ** 2, axis=1)
+    )
+
+    splits = [0]
+    target = chunk_seconds * 10
+    search = search_seconds * 10
+    while target + search < frames:
+        low = max(target - search, splits[-1] // frame + 1)
+        quietest = low + int(np.argmin(energy[low : target + search]))
+        splits.append(quietest * frame)
+        target = quietest + chunk_seconds * 10
+    splits.append(len(audio))
+    return splits
+
+
+def detect_language(whisper_model, audio):
+    # Detect the spoken language from the first 30 seconds, like whisper does
+    whisper = import_whisper()
+    mel = whisper.log_mel_spectrogram(
+        whisper.pad_or_trim(audio), whisper_model.dims.n_mels
+    ).to(whisper_model.device)
+    _, probs = whisper_model.detect_language(mel)
+    return max(probs, key=probs.get)
+
+
+_parallel_model = None
+
+
+def _init_parallel_worker(model):
+    # Runs in each worker process. Converted models are mapped from the same file, so the
+    # workers share its pages. int8 models are unpickled, so each worker has its own copy.
+    global _parallel_model
+    _parallel_model = load_whisper_model(model)
+
+
+def _transcribe_chunk(chunk):
+    import torch
+
+    audio, offset, own_start, own_end, language, threads = chunk
+    # The pool outlives the request, and the next one can get a different share of the cores
+    if torch.get_num_threads() != threads:
+        torch.set_num_threads(threads)
+    result = _parallel_model.transcribe(audio, language=language)
+
+    # Chunks overlap, so only keep the segments that are centered in this chunk's own part
+    segments = []
+    for segment in result["segments"]:
+        start = offset + segment["start"]
+        end = offset + segment["end"]
+        if own_start <= (start + end) / 2 < own_end:
+            segments.append({"start": start, "end": end, "text": segment["text"]})
+    return segments
+
+
+class ParallelPool:
+    """
+    Worker processes that each have a whisper model loaded, for transcribe_parallel. Starting
+    them means importing torch and whisper and loading the model again, so they're kept in
+    loaded_models like a model, and reused until they sit idle or get evicted.
+    """
+
+    def __init__(self, model, workers):
+        import torch.multiprocessing
+
+        context = torch.multiprocessing.get_context("spawn")
+        self.workers = workers
+        self.pool = context.Pool(
+            workers, initializer=_init_parallel_worker, initargs=(model,)
+        )
+
+    def imap_unordered(self, function, items):
+        return self.pool.imap_unordered(function, items)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def use_parallel_pool(model, workers):
+    # Every worker runs the model on its own chunk, and int8 models are a copy in each worker
+    return loaded_models.use(
+        f"whisper/{model}/parallel/{workers}",
+        lambda: ParallelPool(model, workers),
+        whisper_ram_estimates[model] * workers,
+    )
+
+
+def transcribe_parallel(model, whisper_model, audio, workers, on_progress=None):
+    """
+    Transcribe audio in chunks split at quiet moments, across a pool of worker processes that
+    each have the model loaded, and stitch the segments back together in order. whisper_model
+    is only used to detect the language.
+    """
+    splits = find_quiet_splits(audio, PARALLEL_CHUNK_SECONDS)
+    overlap = PARALLEL_OVERLAP_SECONDS * SAMPLE_RATE
+    language = detect_language(whisper_model, audio)
+    threads = max(1, cpu_scheduler.current_threads() // workers)
+
+    chunks = []
+    for own_start, own_end in zip(splits, splits[1:]):
+        start = max(0, own_start - overlap)
+        end = min(len(audio), own_end + overlap)
+        chunks.append(
+            (
+                audio[start:end],
+                start / SAMPLE_RATE,
+                own_start / SAMPLE_RATE,
+                own_end / SAMPLE_RATE,
+                language,
+                threads,
+            )
+        )
+
+    print(f"Transcribing {len(chunks)} chunks with {workers} workers")
+
+    segments = []
+    with use_parallel_pool(model, workers) as pool:
+        for i, chunk_segments in enumerate(
+            pool.imap_unordered(_transcribe_chunk, chunks)
+        ):
+            segments.extend(chunk_segments)
+            if on_progress:
+                on_progress((i + 1) / len(chunks))
+
+    # Put the segments in order, dropping any repeats where chunks overlap
+    segments.sort(key=lambda segment: segment["start"])
+    stitched = []
+    for segment in segments:
+        if (
+            stitched
+            and segment["text"].strip() == stitched[-1]["text"].strip()
+            and segment["start"] < stitched[-1]["end"]
+        ):
+            continue
+        stitched.append(segment)
+    return stitched
+
+
+class SpeakerIndex:
+    """
+    Diarization turns, for finding who was speaking during a segment without checking every
+    turn. Long meetings can have thousands of turns. The timeline is split at every turn's start
+    and end, and each speaker gets the time they've spoken up to each split, so a lookup takes a
+    binary search plus one step per speaker, however long the turns around it are.
+    """
+
+    def __init__(self, turns):
+        turns = sorted(turns)
+        self.starts = [start for start, _, _ in turns]
+        self.ends = [end for _, end, _ in turns]
+        self.speakers = [speaker for _, _, speaker in turns]
+
+        # The latest end of any turn up to each index, and which turn that is, for finding the
+        # nearest turn before a segment
+        self.max_ends = list(itertools.accumulate(self.ends, max))
+        self.latest = list(
+            itertools.accumulate(((end, k) for k, end in enumerate(self.ends)), max)
+        )
+
+        self.boundaries = sorted(set(self.starts) | set(self.ends))
+        changes = {}
+        for start, end, speaker in turns:
+            change = changes.setdefault(speaker, [0] * len(self.boundaries))
+            change[bisect.bisect_left(self.boundaries, start)] += 1
+            change[bisect.bisect_left(self.boundaries, end)] -= 1
+
+        # For each speaker, how many of their turns cover each piece between two boundaries, and
+        # how long they've spoken up to each boundary
+        self.speaking = {}
+        lengths = [b - a for a, b in zip(self.boundaries, self.boundaries[1:])]
+        for speaker, change in changes.items():
+            counts = list(itertools.accumulate(change[:-1]))
+            spoken = [0]
+            spoken.extend(
+                itertools.accumulate(
+                    count * length for count, length in zip(counts, lengths)
+                )
+            )
+            self.speaking[speaker] = (counts, spoken)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def _spoken(self, speaker, t):
+        # How long the speaker has spoken up to time t
+        counts, spoken = self.speaking[speaker]
+        k = bisect.bisect_right(self.boundaries, t) - 1
+        if k < 0:
+            return 0
+        if k >= len(counts):
+            return spoken[-1]
+        return spoken[k] + (t - self.boundaries[k]) * counts[k]
+
+    def speaker(self, start, end):
+        # Returns the speaker whose turns overlap the most with the time between start and end,
+        # or the speaker of the closest turn if none overlap
+        if not self.starts:
+            return None
+
+        overlaps = {}
+        for speaker in self.speaking:
+            overlap = self._spoken(speaker, end) - self._spoken(speaker, start)
+            if overlap > 0:
+                overlaps[speaker] = overlap
+        if overlaps:
+            return max(overlaps, key=overlaps.get)
+
+        # Nothing overlaps, so use the nearest turn before or after the segment
+        i = bisect.bisect_left(self.starts, end)
+        # Clamped for a segment around turns that take no time at all
+        before = max(0, bisect.bisect_right(self.max_ends, start) - 1)
+        candidates = [(start - self.max_ends[before], before)]
+        if i < len(self.starts):
+            candidates.append((self.starts[i] - end, i))
+        _, nearest = min(candidates)
+        if nearest == before:
+            # max_ends only says some turn up to here ended at that time, so look up which one
+            _, nearest = self.latest[before]
+        return self.speakers[nearest]
+
+
+def get_speech_regions(speakers, duration, padding=VAD_PADDING_SECONDS):
+    # Pads the detected turns, and merges the ones that overlap, into sorted (start, end) regions
+    regions = []
+    for start, end in sorted(zip(speakers.starts, speakers.ends)):
+        start = max(0, start - padding)
+        end = min(duration, end + padding)
+        if regions and start <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], end)
+        else:
+            regions.append([start, end])
+    return [(start, end) for start, end in regions if end > start]
+
+
+class SpeechAudio:
+    """
+    Only the speech regions of some audio, joined together, along with where each region came
+    from so timestamps in the joined audio can be mapped back to the original audio.
+    """
+
+    def __init__(self, audio, regions):
+        self.starts = []
+        self.original_starts = []
+        pieces = []
+        offset = 0
+        for start, end in regions:
+            piece = audio[int(start * SAMPLE_RATE) : int(end * SAMPLE_RATE)]
+            self.starts.append(offset / SAMPLE_RATE)
+            self.original_starts.append(start)
+            pieces.append(piece)
+            offset += len(piece)
+
+        if pieces:
+            self.audio = np.concatenate(pieces)
+        else:
+            self.audio = np.zeros(0, dtype=np.float32)
+        self.duration = len(self.audio) / SAMPLE_RATE
+        self.skipped_seconds = len(audio) / SAMPLE_RATE - self.duration
+
+    def original_time(self, t, end=False):
+        # A time right on the boundary between two regions is the end of the earlier one, or
+        # the start of the later one
+        if end:
+            i = max(0, bisect.bisect_left(self.starts, t) - 1)
+        else:
+            i = max(0, bisect.bisect_right(self.starts, t) - 1)
+        return self.original_starts[i] + t - self.starts[i]
+
+
+def load_pyannote_pipeline():
+    from pyannote.audio import Pipeline as PyannotePipeline
+
+    model_config = os.path.join(get_models_dir(), "pyannote", "config.yaml")
+    print(model_config)
+    return PyannotePipeline(model_config)
+
+
+def diarize(audio, timings=None):
+    import torch
+
+    timings = timings or Timings()
+    with loaded_models.use(
+        "pyannote",
+        timings.timed("pyannote_load", load_pyannote_pipeline),
+        pyannote_ram_estimate,
+    ) as pipeline, timings.stage("diarization"), cpu_scheduler.slot():
+        diarization = pipeline(
+            {
+                "waveform": torch.from_numpy(audio).unsqueeze(0),
+                "sample_rate": SAMPLE_RATE,
+            }
+        )
+
+    speakers = SpeakerIndex(
+        [
+            (turn.start, turn.end, speaker)
+            for turn, _, speaker in diarization.itertracks(yield_label=True)
+        ]
+    )
+    print(f"Speaker diarization found {len(speakers)} turns")
+    return speakers
+
+
+# Runs speaker diarization in the background while whisper transcribes
+diarization_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=get_inference_workers(), thread_name_prefix="diarization"
+)
+
+
+def iter_transcription(
+    model,
+    filename,
+    window_seconds,
+    job=None,
+    workers=1,
+    diarize_speakers=True,
+    vad=False,
+    stats=None,
+    timings=None,
+):
+    """
+    Decode, diarize and transcribe an audio file, yielding segments as whisper finishes them.
+    Diarization runs at the same time as transcription, so segments that are ready before it
+    finishes are yielded with a speaker of None, and have their speaker filled in (in place)
+    once it's done, before this generator finishes.
+
+    With vad, diarization runs first and only the speech it found is sent to whisper. How much
+    audio was skipped gets stored in the stats dict, if there is one.
+    """
+    timings = timings or Timings()
+
+    # Decode the audio once, or load it from the feature cache, and share the same samples with
+    # both pyannote and whisper
+    print(f"Loading audio: {filename}")
+    if job:
+        job.update(stage="decode")
+    audio_hash, audio = load_audio(filename, timings)
+    features = AudioFeatures(audio_hash, audio, timings)
+    metrics.increment("audio_seconds_total", len(audio) / SAMPLE_RATE)
+
+    # Speaker diarization
+    diarization = None
+    if diarize_speakers or vad:
+        print(f"Speaker diarization: {filename}")
+        diarization = diarization_executor.submit(diarize, audio, timings)
+
+    # Voice activity detection
+    duration = len(audio) / SAMPLE_RATE
+    speech = None
+    if vad:
+        if job:
+            job.update(stage="vad")
+        speakers = diarization.result()
+        speech = SpeechAudio(audio, get_speech_regions(speakers, duration))
+        print(
+            f"Voice activity detection skipped {speech.skipped_seconds:.1f}s of {duration:.1f}s"
+        )
+        if stats is not None:
+            stats["speech_seconds"] = speech.duration
+            stats["skipped_seconds"] = speech.skipped_seconds
+            stats["skipped_ratio"] = (
+                speech.skipped_seconds / duration if duration else 0
+            )
+        if not diarize_speakers:
+            diarization = None
+        audio = speech.audio
+        duration = speech.duration
+        # The cached spectrogram is of the whole recording, not just the speech
+        features = None
+
+    # Transcribe
+    if job:
+        job.check_canceled()
+        job.update(stage="transcribe")
+    with loaded_models.use(
+        f"whisper/{model}",
+        timings.timed("whisper_load", lambda: load_whisper_model(model)),
+        whisper_ram_estimates[model],
+        exclusive=True,
+    ) as whisper_model, cpu_scheduler.slot():
+        print(f"Transcribing: {filename}")
+
+        if len(audio) == 0:
+            segments = []
+        elif workers > 1 and whisper_model.device.type == "cpu":
+
+            def on_progress(fraction):
+                if job:
+                    job.check_canceled()
+                    job.update(progress=min(99, fraction * 100))
+
+            # The workers transcribe everything before the segments come back, so time it
+            # here, where timed_iter below would only time going through the list
+            with timings.stage("asr"):
+                segments = transcribe_parallel(
+                    model, whisper_model, audio, workers, on_progress
+                )
+        else:
+            segments = iter_transcribe_segments(
+                whisper_model, audio, window_seconds, features
+            )
+
+        waiting_for_speaker = []
+        for segment in timings.timed_iter("asr", segments):
+            if job:
+                job.check_canceled()
+                job.update(progress=min(99, segment["end"] / duration * 100))
+
+            if speech:
+                segment["start"] = speech.original_time(segment["start"])
+                segment["end"] = speech.original_time(segment["end"], end=True)
+
+            segment["speaker"] = None
+            if diarization and diarization.done():
+                speakers = diarization.result()
+                segment["speaker"] = speakers.speaker(segment["start"], segment["end"])
+            elif diarization:
+                waiting_for_speaker.append(segment)
+            yield segment
+
+    # Join the two stages
+    if diarization:
+        if job:
+            job.update(stage="diarization")
+        speakers = diarization.result()
+        for segment in waiting_for_speaker:
+            segment["speaker"] = speakers.speaker(segment["start"], segment["end"])
+
+
+transcription_cache = ResultCache(
+    get_cache_path(), "transcriptions", get_result_cache_size()
+)
+
+
+def get_transcription_cache_key(model, filename, options):
+    # Identify a transcription by the audio itself, not its filename
+    return hashlib.sha256(
+        json.dumps(
+            {
+                "audio": file_hashes.hash(filename),
+                "model": model,
+                "options": options,
+            },
+            sort_keys=True,
+        ).encode()
+    ).hexdigest()
+
+
+def admit_transcription(model, filename, diarize_speakers, vad, priority, job=None):
+    # Waits until there's memory for the models and the audio
+    duration = get_audio_duration(filename) or 0
+    models = {f"whisper/{model}": whisper_ram_estimates[model]}
+    if diarize_speakers or vad:
+        models["pyannote"] = pyannote_ram_estimate
+    if job:
+        job.update(stage="admission")
+    return admission.admit(
+        "transcribe",
+        models,
+        int(duration * transcribe_ram_per_second),
+        priority,
+        wait=job is not None,
+    )
+
+
+def do_transcribe(
+    model,
+    filename,
+    job=None,
+    use_cache=True,
+    workers=None,
+    diarize_speakers=True,
+    vad=False,
+    priority="normal",
+):
+    start_time = time.time()
+    timings = Timings()
+    # More worker processes than cores would only fight over them
+    workers = min(int(workers or get_transcribe_workers()), len(get_available_cores()))
+    workers = max(1, workers)
+
+    # Anything that changes the transcription needs to be part of the cache key
+    options = {"window_seconds": TRANSCRIBE_WINDOW_SECONDS, "segments": True}
+    if workers > 1:
+        options = {"parallel_chunk_seconds": PARALLEL_CHUNK_SECONDS, "segments": True}
+    options["diarize"] = bool(diarize_speakers)
+    if vad:
+        options["vad_padding_seconds"] = VAD_PADDING_SECONDS
+    if use_cache:
+        if job:
+            job.update(stage="cache")
+        with timings.stage("cache"):
+            cache_key = get_transcription_cache_key(model, filename, options)
+            transcription = transcription_cache.get(cache_key)
+        if transcription is not None:
+            print(f"Transcription cache hit: {filename}")
+            metrics.increment("transcription_cache_hits_total")
+            transcription["cached"] = True
+            transcription["time_elapsed"] = time.time() - start_time
+            transcription["timings"] = timings.to_dict()
+            return transcription
+
+    stats = {}
+    with admit_transcription(model, filename, diarize_speakers, vad, priority, job):
+        segments = list(
+            iter_transcription(
+                model,
+                filename,
+                TRANSCRIBE_WINDOW_SECONDS,
+                job,
+                workers,
+                diarize_speakers,
+                vad,
+                stats,
+                timings,
+            )
+        )
+    elapsed_time = time.time() - start_time
+    metrics.increment("transcriptions_total")
+
+    text = "".join(segment["text"] for segment in segments).strip()
+    print(f"Transcription finished:\n{text}")
+    transcription = {
+        "success": True,
+        "result": text,
+        "segments": [
+            {
+                "speaker": segment["speaker"],
+                "start": segment["start"],
+                "end": segment["end"],
+                "text": segment["text"].strip(),
+            }
+            for segment in segments
+        ],
+        "time_elapsed": elapsed_time,
+        **stats,
+    }
+
+    if use_cache:
+        transcription_cache.put(cache_key, transcription)
+    transcription["cached"] = False
+    transcription["timings"] = timings.to_dict()
+    return transcription
+
+
+class BatchItem(Job):
+    """
+    One file in a batch transcription. It gets passed to do_transcribe in place of a job, and
+    reports every change back to the batch.
+    """
+
+    def __init__(self, batch, filename, on_change):
+        super().__init__("transcribe", {"filename": filename})
+        self.filename = filename
+        self.duration = None
+        self.canceled = batch.canceled
+        self.on_change = on_change
+
+    def update(self, **fields):
+        super().update(**fields)
+        self.on_change()
+
+    def to_dict(self):
+        return {
+            "filename": self.filename,
+            "duration": self.duration,
+            "state": self.state,
+            "stage": self.stage,
+            "progress": self.progress,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+def find_audio_files(directory):
+    filenames = []
+    for dirpath, _, basenames in os.walk(directory):
+        for basename in basenames:
+            if basename.lower().endswith(audio_extensions):
+                filenames.append(os.path.join(dirpath, basename))
+    return sorted(filenames)
+
+
+def do_transcribe_batch(
+    model,
+    filenames,
+    job,
+    use_cache=True,
+    diarize_speakers=True,
+    vad=False,
+    priority="low",
+):
+    start_time = time.time()
+    report_lock = threading.Lock()
+
+    def report():
+        # Progress is weighted by duration, since long files take longer
+        with report_lock:
+            total = sum(item.duration or 1 for item in items)
+            progress = sum(
+                (item.duration or 1) * (100 if item.done else item.progress)
+                for item in items
+            )
+            job.update(
+                progress=min(99, progress / total),
+                result={"files": [item.to_dict() for item in items]},
+            )
+
+    items = [BatchItem(job, filename, report) for filename in filenames]
+
+    # Check every file and find how long it is first, so the longest ones can start first and
+    # the short ones fill in the gaps at the end
+    job.update(stage="scan")
+    runnable = []
+    for item in items:
+        job.check_canceled()
+        error = validate_audio_file(item.filename)
+        if error is None:
+            item.duration = get_audio_duration(item.filename)
+            if item.duration is None:
+                error = "Could not read the audio file"
+        if error:
+            item.update(state="failed", error=error, finished=time.time())
+        else:
+            runnable.append(item)
+    runnable.sort(key=lambda item: item.duration, reverse=True)
+
+    def run(item):
+        with jobs.slot():
+            run_item(item)
+
+    def run_item(item):
+        if job.canceled.is_set():
+            item.update(state="canceled", finished=time.time())
+            return
+
+        item.update(state="running", started=time.time())
+        try:
+            result = do_transcribe(
+                model,
+                item.filename,
+                item,
+                use_cache,
+                1,
+                diarize_speakers,
+                vad,
+                priority,
+            )
+            item.update(
+                state="finished", progress=100, result=result, finished=time.time()
+            )
+        except JobCanceled:
+            item.update(state="canceled", finished=time.time())
+        except Exception as e:
+            app.logger.error(traceback.format_exc())
+            item.update(state="failed", error=str(e), finished=time.time())
+
+    # Keep the models leased for the whole batch, so they can't be unloaded between files. Each
+    # file still takes its own exclusive whisper instance in do_transcribe, the files running at
+    # the same time can't share one.
+    job.update(stage="transcribe")
+    with contextlib.ExitStack() as leases:
+        leases.enter_context(
+            loaded_models.use(
+                f"whisper/{model}",
+                lambda: load_whisper_model(model),
+                whisper_ram_estimates[model],
+            )
+        )
+        if diarize_speakers or vad:
+            leases.enter_context(
+                loaded_models.use(
+                    "pyannote", load_pyannote_pipeline, pyannote_ram_estimate
+                )
+            )
+
+        # The files take inference slots from the job queue, starting with this job's own, so
+        # the batch and other jobs together don't run more than NEURONBOX_INFERENCE_WORKERS
+        with jobs.lend_slot(), concurrent.futures.ThreadPoolExecutor(
+            max_workers=get_inference_workers(), thread_name_prefix="batch"
+        ) as executor:
+            list(executor.map(run, runnable))
+
+    job.check_canceled()
+    files = [item.to_dict() for item in items]
+    return {
+        "success": True,
+        "files": files,
+        "finished": sum(1 for item in items if item.state == "finished"),
+        "failed": sum(1 for item in items if item.state == "failed"),
+        "time_elapsed": time.time() - start_time,
+    }
+
+
+def validate_transcribe_request(filename, model):
+    # Returns an error message, or None if the request is valid
+    return validate_audio_file(filename) or validate_transcribe_model(model)
+
+
+def validate_audio_file(filename):
+    try:
+        if not os.path.exists(filename):
+            return "File does not exist"
+
+        if not filename.lower().endswith(audio_extensions):
+            basename = os.path.basename(filename)
+            return f"{basename} is not an audio file"
+    except Exception as e:
+        return f"Invalid file: {e}"
+
+    return None
+
+
+def validate_transcribe_model(model):
+    # Validate model, it should be one of the whisper models
+    entry = model_catalog.get("transcribe", model)
+    if entry is None or entry["kind"] != "whisper":
+        return f"Invalid model: {model}"
+
+    # Make sure the model is actually downloaded
+    if not model_catalog.is_downloaded(entry):
+        return f'You must download the model "{model}" before you can use it'
+
+    return None
+
+
+def stream_transcription(
+    model, filename, diarize_speakers=True, vad=False, priority="normal"
+):
+    # The events for /transcribe/stream: each segment as soon as it's ready, then the speakers
+    # of segments that were ready before diarization was, and then the whole result
+    start_time = time.time()
+    text = ""
+    segments = []
+    stats = {}
+    timings = Timings()
+    with admit_transcription(model, filename, diarize_speakers, vad, priority):
+        for segment in iter_transcription(
+            model,
+            filename,
+            STREAM_WINDOW_SECONDS,
+            diarize_speakers=diarize_speakers,
+            vad=vad,
+            stats=stats,
+            timings=timings,
+        ):
+            text += segment["text"]
+            segments.append((segment, segment["speaker"]))
+            yield {"type": "segment", **segment}
+
+    for index, (segment, speaker) in enumerate(segments):
+        if speaker is None and segment["speaker"] is not None:
+            yield {"type": "speaker", "index": index, "speaker": segment["speaker"]}
+
+    metrics.increment("transcriptions_total")
+    yield {
+        "type": "done",
+        "result": text.strip(),
+        "time_elapsed": time.time() - start_time,
+        **stats,
+        "timings": timings.to_dict(),
+    }
+
+
+@app.route("/transcribe", methods=["POST"])
+def transcribe():
+    filename = request.json.get("filename")
+    model = request.json.get("model")
+    print(f"Transcribing: {filename} with {model}")
+
+    error = validate_transcribe_request(filename, model)
+    if error:
+        return jsonify({"success": False, "error": error})
+
+    use_cache = request.json.get("cache", True)
+    workers = request.json.get("workers")
+    diarize_speakers = request.json.get("diarize", True)
+    vad = request.json.get("vad", False)
+    priority = request.json.get("priority", "normal")
+    error = validate_priority(priority) or validate_workers(workers)
+    if error:
+        return jsonify({"success": False, "error": error})
+
+    transcription = model_host.call(
+        "transcribe",
+        model,
+        filename,
+        use_cache=use_cache,
+        workers=workers,
+        diarize_speakers=diarize_speakers,
+        vad=vad,
+        priority=priority,
+    )
+    return jsonify(transcription)
+
+
+@app.route("/transcribe/stream")
+def transcribe_stream():
+    filename = request.args.get("filename")
+    model = request.args.get("model")
+    diarize_speakers = request.args.get("diarize", "true").lower() != "false"
+    vad = request.args.get("vad", "false").lower() == "true"
+    priority = request.args.get("priority", "normal")
+    print(f"Streaming transcription: {filename} with {model}")
+
+    def generate():
+        error = validate_transcribe_request(filename, model) or validate_priority(
+            priority
+        )
+        if error:
+            yield f"data:{json.dumps({'type': 'error', 'error': error})}\n\n"
+            return
+
+        try:
+            for event in model_host.iter(
+                "stream_transcription", model, filename, diarize_speakers, vad, priority
+            ):
+                yield f"data:{json.dumps(event)}\n\n"
+        except ServerBusy as e:
+            retry_after = math.ceil(e.retry_after)
+            event = {
+                "type": "error",
+                "error": f"The server is busy, try again in about {retry_after} seconds",
+                "retry_after": retry_after,
+            }
+            yield f"data:{json.dumps(event)}\n\n"
+        except Exception as e:
+            app.logger.error(traceback.format_exc())
+            yield f"data:{json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+
+    response = app.response_class(
+        stream_with_context(generate()), mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Connection"] = "keep-alive"
+    return response
+
+
+# Jobs
+
+jobs = JobQueue(get_inference_workers(), get_max_queued_jobs())
+
+
+class AdmissionController:
+    """
+    Keeps the requests running at the same time within a memory budget, so a few big
+    transcriptions can't push the machine into swap. Each request says roughly how much memory
+    its models and its audio need, and models that a running request already uses aren't
+    counted again. Models the registry keeps loaded count too, and idle ones are unloaded to
+    make room for a request that doesn't need them. Requests that don't fit wait, highest
+    priority first. When too many are
+    waiting, new ones are turned away with an estimate of when to try again, except for jobs,
+    which have already been accepted and wait as long as it takes.
+    """
+
+    def __init__(self, budget, max_waiting, registry=None):
+        self.budget = budget
+        self.max_waiting = max_waiting
+        self.registry = registry
+        self.condition = threading.Condition()
+        # Model key -> [size, how many running requests use it]
+        self.models = {}
+        self.working_memory = 0
+        # Kind of request -> how many are running, and how long they've been taking
+        self.running = {}
+        self.average_seconds = {}
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    def used(self):
+        return (
+            self.working_memory
+            + sum(size for size, _ in self.models.values())
+            + sum(size for _, size, _ in self._resident())
+        )
+
+    def _resident(self):
+        # Loaded models that no running request was admitted with, like ones left loaded after
+        # the requests that used them finished
+        if self.registry is None:
+            return []
+        return [
+            (key, size, in_use)
+            for key, size, in_use in self.registry.resident_models()
+            if key not in self.models
+        ]
+
+    def _fits(self, models, working_memory):
+        resident = self._resident()
+        resident_keys = {key for key, _, _ in resident}
+        needed = working_memory + sum(
+            size
+            for key, size in models.items()
+            if key not in self.models and key not in resident_keys
+        )
+        used = self.used()
+
+        # Unload idle models this request doesn't need, least recently used first, until it fits
+        for key, size, in_use in resident:
+            if used + needed <= self.budget:
+                break
+            if not in_use and key not in models and self.registry.unload_if_idle(key):
+                used -= size
+
+        # Something that needs more than the whole budget can still run on its own
+        return not self.running or used + needed <= self.budget
+
+    def estimate_wait(self, kind):
+        # Requests take as long as ones of their kind have been taking, the ones running now
+        # are half done on average, and as many run at once as are running now
+        def seconds(kind):
+            return self.average_seconds.get(kind, 10.0)
+
+        total = seconds(kind)
+        total += sum(seconds(kind) * count / 2 for kind, count in self.running.items())
+        total += sum(seconds(kind) for _, _, kind in self.waiting)
+        return total / max(1, sum(self.running.values()))
+
+    @contextlib.contextmanager
+    def admit(self, kind, models, working_memory, priority="normal", wait=False):
+        with self.condition:
+            if self.waiting or not self._fits(models, working_memory):
+                if not wait and len(self.waiting) >= self.max_waiting:
+                    metrics.increment("admission_rejections_total")
+                    raise ServerBusy(self.estimate_wait(kind))
+
+                # Only the first in line can go, even if something smaller behind it would
+                # fit, so big requests don't wait forever
+                ticket = (PRIORITIES[priority], next(self.sequence), kind)
+                heapq.heappush(self.waiting, ticket)
+                start_time = time.perf_counter()
+                self.condition.wait_for(
+                    lambda: self.waiting[0] == ticket
+                    and self._fits(models, working_memory)
+                )
+                heapq.heappop(self.waiting)
+                metrics.observe("admission", time.perf_counter() - start_time)
+                # The next in line might fit too
+                self.condition.notify_all()
+
+            for key, size in models.items():
+                self.models.setdefault(key, [size, 0])[1] += 1
+            self.working_memory += working_memory
+            self.running[kind] = self.running.get(kind, 0) + 1
+
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            with self.condition:
+                for key in models:
+                    self.models[key][1] -= 1
+                    if self.models[key][1] == 0:
+                        del self.models[key]
+                self.working_memory -= working_memory
+                self.running[kind] -= 1
+                if self.running[kind] == 0:
+                    del self.running[kind]
+                elapsed_time = time.time() - start_time
+                self.average_seconds[kind] = (
+                    0.8 * self.average_seconds.get(kind, elapsed_time)
+                    + 0.2 * elapsed_time
+                )
+                self.condition.notify_all()
+
+
+admission = AdmissionController(
+    get_admission_memory_budget(), get_max_waiting_requests(), loaded_models
+)
+
+
+def submit_job(kind, params):
+    # Jobs are submitted by kind, with their parameters, so they can be sent to the model host
+    if kind == "transcribe":
+        fn = lambda job: do_transcribe(
+            params["model"],
+            params["filename"],
+            job,
+            params["cache"],
+            params["workers"],
+            params["diarize"],
+            params["vad"],
+            params.get("priority", "low"),
+        )
+    elif kind == "batch":
+        fn = lambda job: do_transcribe_batch(
+            params["model"],
+            params["filenames"],
+            job,
+            params["cache"],
+            params["diarize"],
+            params["vad"],
+            params.get("priority", "low"),
+        )
+    else:
+        raise ValueError(f"Invalid job kind: {kind}")
+    return jobs.submit(kind, params, fn).to_dict()
+
+
+def get_job(job_id):
+    job = jobs.get(job_id)
+    return job.to_dict() if job else None
+
+
+def cancel_job(job_id):
+    job = jobs.cancel(job_id)
+    return job.to_dict() if job else None
+
+
+def wait_for_job(job_id, version, timeout):
+    # Returns the job's new version and status once it changes, or the same version after the
+    # timeout if nothing happened
+    job = jobs.get(job_id)
+    if job is None:
+        return None, None
+    version = job.wait_for_change(version, timeout)
+    return version, job.to_dict()
+
+
+@app.route("/jobs")
+def jobs_list():
+    return jsonify({"jobs": model_host.call("jobs.list")})
+
+
+@app.route("/jobs/transcribe", methods=["POST"])
+def jobs_transcribe():
+    filename = request.json.get("filename")
+    model = request.json.get("model")
+    use_cache = request.json.get("cache", True)
+    workers = request.json.get("workers")
+    diarize_speakers = request.json.get("diarize", True)
+    vad = request.json.get("vad", False)
+    priority = request.json.get("priority", "low")
+    print(f"Queueing transcription: {filename} with {model}")
+
+    error = (
+        validate_transcribe_request(filename, model)
+        or validate_priority(priority)
+        or validate_workers(workers)
+    )
+    if error:
+        return jsonify({"success": False, "error": error})
+
+    try:
+        job = model_host.call(
+            "jobs.submit",
+            "transcribe",
+            {
+                "filename": filename,
+                "model": model,
+                "cache": use_cache,
+                "workers": workers,
+                "diarize": diarize_speakers,
+                "vad": vad,
+                "priority": priority,
+            },
+        )
+    except JobQueueFull:
+        return jsonify({"success": False, "error": "Too many jobs are queued"}), 429
+
+    return jsonify({"success": True, "job_id": job["id"]})
+
+
+@app.route("/jobs/batch", methods=["POST"])
+def jobs_batch():
+    filenames = list(request.json.get("filenames") or [])
+    directory = request.json.get("directory")
+    model = request.json.get("model")
+    use_cache = request.json.get("cache", True)
+    diarize_speakers = request.json.get("diarize", True)
+    vad = request.json.get("vad", False)
+    priority = request.json.get("priority", "low")
+
+    if directory:
+        if not os.path.isdir(directory):
+            return jsonify({"success": False, "error": "Directory does not exist"})
+        filenames += find_audio_files(directory)
+    if not filenames:
+        return jsonify({"success": False, "error": "No audio files to transcribe"})
+    print(f"Queueing batch transcription: {len(filenames)} files with {model}")
+
+    error = validate_transcribe_model(model) or validate_priority(priority)
+    if error:
+        return jsonify({"success": False, "error": error})
+
+    try:
+        job = model_host.call(
+            "jobs.submit",
+            "batch",
+            {
+                "filenames": filenames,
+                "model": model,
+                "cache": use_cache,
+                "diarize": diarize_speakers,
+                "vad": vad,
+                "priority": priority,
+            },
+        )
+    except JobQueueFull:
+        return jsonify({"success": False, "error": "Too many jobs are queued"}), 429
+
+    return jsonify({"success": True, "job_id": job["id"], "files": len(filenames)})
+
+
+@app.route("/jobs/<job_id>")
+def jobs_status(job_id):
+    job = model_host.call("jobs.get", job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify({"success": True, "job": job})
+
+
+@app.route("/jobs/<job_id>/events")
+def jobs_events(job_id):
+    if model_host.call("jobs.get", job_id) is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+
+    def generate():
+        version = None
+        while True:
+            new_version, status = model_host.call("jobs.wait", job_id, version, 15)
+            if status is None:
+                break
+            if new_version != version:
+                version = new_version
+                yield f"data:{json.dumps(status)}\n\n"
+                if status["state"] in ("finished", "failed", "canceled"):
+                    break
+            else:
+                # Keep the connection alive while nothing is happening
+                yield ":\n\n"
+
+    response = app.response_class(
+        stream_with_context(generate()), mimetype="text/event-stream"
+    )
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Connection"] = "keep-alive"
+    return response
+
+
+@app.route("/jobs/<job_id>/cancel", methods=["POST"])
+def jobs_cancel(job_id):
+    print(f"Canceling job: {job_id}")
+    job = model_host.call("jobs.cancel", job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify({"success": True}), 200
+
+
+# Translate
+
+
+@app.route("/languages")
+def languages():
+    return jsonify(language_codes)
+
+
+# Split on whitespace that follows the end of a sentence
+sentence_boundary_re = re.compile(r"(?<=[.!?。！？])\s+")
+
+
+def split_sentences(text):
+    # Returns a list of paragraphs, each a list of sentences, so the translation can be put
+    # back together with the same line breaks as the source text
+    return [
+        [sentence for sentence in sentence_boundary_re.split(line.strip()) if sentence]
+        for line in text.split("\n")
+    ]
+
+
+def join_sentences(paragraphs):
+    return "\n".join(" ".join(sentences) for sentences in paragraphs)
+
+
+def load_translate_model(model_path, quantized=False):
+    import torch
+    from transformers import AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM
+
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if quantized:
+        # Build an empty model with the same quantized layers, then fill in the saved weights
+        model = AutoModelForSeq2SeqLM.from_config(
+            AutoConfig.from_pretrained(model_path)
+        )
+        model = quantize_linear_layers(model)
+        model.load_state_dict(
+            torch.load(
+                os.path.join(model_path, helsinki_quantized_filename),
+                map_location="cpu",
+                weights_only=False,
+            )
+        )
+        load_generation_config(model, model_path)
+    else:
+        if not os.path.exists(os.path.join(model_path, helsinki_converted_filename)):
+            convert_translate_model(model_path)
+        model = load_mapped_translate_model(model_path)
+    model.eval()
+    return tokenizer, model
+
+
+def translate_sentences(tokenizer, model, sentences, timings=None):
+    import torch
+
+    timings = timings or Timings()
+    max_sentences = get_translate_batch_size()
+    max_tokens = get_translate_batch_tokens()
 
-    generated_ids = model.generate(**batch)
-    result = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+    with timings.stage("tokenize"):
+        input_ids = tokenizer(sentences, truncation=True)["input_ids"]
+
+    # Sort by length so each padded batch holds sentences of similar size. The longest sentence
+    # comes first, so a batch's padded size is its length times the number of sentences.
+    order = sorted(range(len(sentences)), key=lambda i: len(input_ids[i]), reverse=True)
+    batches = []
+    for i in order:
+        if (
+            batches
+            and len(batches[-1]) < max_sentences
+            and (len(batches[-1]) + 1) * len(input_ids[batches[-1][0]]) <= max_tokens
+        ):
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+
+    translations = [None] * len(sentences)
+    for indexes in batches:
+        cpu_scheduler.refresh()
+        with timings.stage("tokenize"):
+            batch = tokenizer.pad(
+                {"input_ids": [input_ids[j] for j in indexes]}, return_tensors="pt"
+            )
+        with timings.stage("generate"), torch.inference_mode():
+            generated_ids = model.generate(**batch)
+        # Turning the generated tokens back into text counts as tokenizing too
+        with timings.stage("tokenize"):
+            results = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+        for j, result in zip(indexes, results):
+            translations[j] = result
+
+    return translations
+
+
+class TranslationMemory:
+    """
+    Remembers translated sentences, so repeated sentences don't need to be run through the
+    model again. Recently used sentences are kept in memory, and everything is also stored on
+    disk in a ResultCache.
+    """
+
+    def __init__(self, disk_cache, memory_size=10000):
+        self.disk_cache = disk_cache
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def normalize(sentence):
+        return " ".join(unicodedata.normalize("NFC", sentence).split())
+
+    def key(self, model_name, sentence):
+        # The model name covers the language pair, and whether the model is quantized, since
+        # quantized models can translate differently
+        return f"{model_name}:{self.normalize(sentence)}"
+
+    def lookup(self, model_name, sentences):
+        # Returns a dict of the sentences that have been translated before
+        keys = {sentence: self.key(model_name, sentence) for sentence in sentences}
+
+        found = {}
+        with self.lock:
+            for sentence, key in keys.items():
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[sentence] = self.memory[key]
+
+        missing = {key for sentence, key in keys.items() if sentence not in found}
+        if missing:
+            from_disk = self.disk_cache.get_many(missing)
+            self._remember(from_disk)
+            for sentence, key in keys.items():
+                if key in from_disk:
+                    found[sentence] = from_disk[key]
+
+        return found
+
+    def store(self, model_name, translations):
+        items = {
+            self.key(model_name, sentence): translation
+            for sentence, translation in translations.items()
+        }
+        self._remember(items)
+        self.disk_cache.put_many(items)
+
+    def _remember(self, items):
+        with self.lock:
+            for key, translation in items.items():
+                self.memory[key] = translation
+                self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+
+translation_memory = TranslationMemory(
+    ResultCache(get_cache_path(), "translations", get_translation_memory_size())
+)
+
+
+class TranslationBatcher:
+    """
+    Translates the sentences of concurrent requests for the same model together, so they share
+    padded calls to generate instead of each request making its own. The first request to
+    arrive opens a batch and waits a short window for others to join it, or until the batch
+    is full, then translates the whole batch and the others wait for its results.
+    """
+
+    def __init__(self, window, max_sentences, max_tokens):
+        self.window = window
+        self.max_sentences = max_sentences
+        self.max_tokens = max_tokens
+        self.lock = threading.Lock()
+        self.open = {}
+
+    def translate(self, key, sentences, translate_fn):
+        with self.lock:
+            batch = self.open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.open[key] = _TranslationBatch()
+            for sentence in sentences:
+                if sentence not in batch.sentences:
+                    batch.sentences[sentence] = None
+                    batch.tokens += len(sentence) // CHARACTERS_PER_TOKEN + 1
+            if (
+                len(batch.sentences) >= self.max_sentences
+                or batch.tokens >= self.max_tokens
+            ):
+                # Nothing else can join a full batch
+                del self.open[key]
+                batch.full.set()
+
+        if leader:
+            batch.full.wait(self.window)
+            with self.lock:
+                if self.open.get(key) is batch:
+                    del self.open[key]
+            try:
+                batch_sentences = list(batch.sentences)
+                batch.translations = dict(
+                    zip(batch_sentences, translate_fn(batch_sentences))
+                )
+                metrics.increment("translation_batches_total")
+            except Exception as e:
+                batch.error = e
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+
+        if batch.error:
+            raise batch.error
+        return {sentence: batch.translations[sentence] for sentence in sentences}
+
+
+class _TranslationBatch:
+    def __init__(self):
+        # Used as an ordered set
+        self.sentences = {}
+        self.tokens = 0
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.translations = None
+        self.error = None
+
+
+translation_batcher = TranslationBatcher(
+    get_translate_batch_window(),
+    get_translate_batch_size(),
+    get_translate_batch_tokens(),
+)
+
+
+def do_translate(
+    source_text,
+    source_language,
+    target_language="en",
+    quantized=False,
+    priority="normal",
+):
+    model_name = f"opus-mt-{source_language}-{target_language}"
+    model_path = os.path.join(get_models_dir(), "Helsinki-NLP", model_name)
+    ram_estimate = translate_ram_estimate
+    if quantized:
+        model_name += QUANTIZED_SUFFIX
+        ram_estimate = translate_int8_ram_estimate
+
+    print(f"Translating from {source_language} to {target_language}: {source_text}")
+
+    start_time = time.time()
+    timings = Timings()
+
+    paragraphs = split_sentences(source_text)
+    sentences = [sentence for sentences in paragraphs for sentence in sentences]
+
+    # Only run the sentences we haven't seen before through the model
+    with timings.stage("translation_memory"):
+        translations = translation_memory.lookup(model_name, sentences)
+    hits = sum(1 for sentence in sentences if sentence in translations)
+    metrics.increment("translated_sentences_total", len(sentences))
+    metrics.increment("translation_memory_hits_total", hits)
+    print(f"Translation memory: found {hits} of {len(sentences)} sentences")
+    missing = list(dict.fromkeys(s for s in sentences if s not in translations))
+
+    def translate_batch(batch_sentences):
+        # Only the request that opened the batch runs this, so the load, tokenize and generate
+        # stages only show up in its timings
+        with loaded_models.use(
+            f"Helsinki-NLP/{model_name}",
+            timings.timed(
+                "translate_load", lambda: load_translate_model(model_path, quantized)
+            ),
+            ram_estimate,
+        ) as (tokenizer, model), cpu_scheduler.slot():
+            return translate_sentences(tokenizer, model, batch_sentences, timings)
+
+    if missing:
+        with admission.admit(
+            "translate",
+            {f"Helsinki-NLP/{model_name}": ram_estimate},
+            translate_working_ram_estimate,
+            priority,
+        ), timings.stage("translate_batch"):
+            new_translations = translation_batcher.translate(
+                model_name, missing, translate_batch
+            )
+
+        translation_memory.store(model_name, new_translations)
+        translations.update(new_translations)
+
+    result = join_sentences(
+        [[translations[sentence] for sentence in sentences] for sentences in paragraphs]
+    )
 
     elapsed_time = time.time() - start_time
 
-    print(f"Translation finished:\n{result[0]}")
-    return {"success": True, "result": result[0], "time_elapsed": elapsed_time}
+    print(f"Translation finished:\n{result}")
+    metrics.increment("translations_total")
+    return {
+        "success": True,
+        "result": result,
+        "time_elapsed": elapsed_time,
+        "timings": timings.to_dict(),
+    }
 
 
 @app.route("/translate", methods=["POST"])
@@ -644,8 +4366,14 @@ def translate():
     source_text = request.json.get("sourceText")
     source_language = request.json.get("sourceLanguage")
     target_language = "en"
+    quantized = request.json.get("quantized", False)
+    priority = request.json.get("priority", "normal")
     print(f"Transcribing: {source_language} to {target_language}")
 
+    error = validate_priority(priority)
+    if error:
+        return jsonify({"success": False, "error": error})
+
     # Validate source language
     if source_language not in language_codes:
         return jsonify(
@@ -653,20 +4381,313 @@ def translate():
         )
 
     # Make sure the model is actually downloaded
-    if not os.path.isdir(
-        os.path.join(get_models_dir(), "Helsinki-NLP", f"opus-mt-{source_language}-en")
-    ):
+    model_name = f"opus-mt-{source_language}-en"
+    if quantized:
+        model_name += QUANTIZED_SUFFIX
+    entry = model_catalog.get("translate", model_name)
+    if entry is None or not model_catalog.is_downloaded(entry):
         return jsonify(
             {
                 "success": False,
-                "error": f'You must download the model "opus-mt-{source_language}-en" before you can use it',
+                "error": f'You must download the model "{model_name}" before you can use it',
             }
         )
 
-    translation = do_translate(source_text, source_language, target_language)
+    translation = model_host.call(
+        "translate", source_text, source_language, target_language, quantized, priority
+    )
     return jsonify(translation)
 
 
+# Model host
+
+# How long to wait for the model host to start answering before giving up on a request
+MODEL_HOST_CONNECT_TIMEOUT = 30
+
+# How often the model host supervisor checks whether the model host or the gunicorn master
+# have exited, which is also how long it waits before restarting the model host
+MODEL_HOST_SUPERVISE_INTERVAL = 1
+
+# How long clients are told to wait before trying again while the model host restarts
+MODEL_HOST_RETRY_AFTER = 5
+
+
+def get_model_host_socket_path():
+    return os.path.join(get_config_dir(), "model-host.sock")
+
+
+class ModelHostUnavailable(Exception):
+    pass
+
+
+class ModelHostError(Exception):
+    pass
+
+
+@app.errorhandler(ModelHostUnavailable)
+def handle_model_host_unavailable(e):
+    # The supervisor restarts the model host, so the request can be tried again soon
+    response = jsonify(
+        {
+            "success": False,
+            "error": f"{e}, try again in about {MODEL_HOST_RETRY_AFTER} seconds",
+            "retry_after": MODEL_HOST_RETRY_AFTER,
+        }
+    )
+    response.headers["Retry-After"] = str(MODEL_HOST_RETRY_AFTER)
+    return response, 503
+
+
+def send_message(sock, message):
+    # Messages are pickled, and prefixed with their length
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    sock.sendall(struct.pack("!Q", len(data)))
+    sock.sendall(data)
+
+
+def receive_message(sock):
+    (length,) = struct.unpack("!Q", _receive_exactly(sock, 8))
+    return pickle.loads(_receive_exactly(sock, length))
+
+
+def _receive_exactly(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            raise ConnectionError("The connection was closed")
+        received += count
+    return buffer
+
+
+def start_warmup(models):
+    return warmup.start([model_catalog.get(feature, name) for feature, name in models])
+
+
+def quantize_catalog_model(feature, name):
+    quantize_model(model_catalog.get(feature, name))
+
+
+def convert_catalog_model(feature, name):
+    convert_model(model_catalog.get(feature, name))
+
+
+# Everything the web server can ask the model host to do. Generators stream their items back.
+model_host_methods = {
+    "transcribe": do_transcribe,
+    "stream_transcription": stream_transcription,
+    "translate": do_translate,
+    "jobs.submit": submit_job,
+    "jobs.get": get_job,
+    "jobs.list": lambda: [job.to_dict() for job in jobs.list()],
+    "jobs.cancel": cancel_job,
+    "jobs.wait": wait_for_job,
+    "models.loaded": lambda: loaded_models.status(),
+    "models.quantize": quantize_catalog_model,
+    "models.convert": convert_catalog_model,
+    "warmup.start": start_warmup,
+    "warmup.status": lambda: warmup.to_dict(),
+}
+
+# These get raised again in the web server when the model host raises them
+model_host_exceptions = {
+    "JobQueueFull": JobQueueFull,
+    "JobCanceled": JobCanceled,
+    "ServerBusy": ServerBusy,
+}
+
+
+class LocalModelHost:
+    """
+    Runs model host methods in this process. The development server uses this, since it's a
+    single process anyway.
+    """
+
+    def call(self, method, *args, **kwargs):
+        return model_host_methods[method](*args, **kwargs)
+
+    def iter(self, method, *args, **kwargs):
+        return iter(model_host_methods[method](*args, **kwargs))
+
+    def is_available(self):
+        return True
+
+
+class RemoteModelHost:
+    """
+    Sends model host methods to the model host process over a Unix socket, one connection per
+    call. gevent patches the socket module, so waiting on the model host doesn't block other
+    requests in the same gunicorn worker.
+    """
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+
+    def call(self, method, *args, **kwargs):
+        with self._connect() as sock:
+            send_message(sock, (method, args, kwargs))
+            kind, value = self._receive(sock)
+            while kind == "yield":
+                kind, value = self._receive(sock)
+            return value
+
+    def iter(self, method, *args, **kwargs):
+        with self._connect() as sock:
+            send_message(sock, (method, args, kwargs))
+            while True:
+                kind, value = self._receive(sock)
+                if kind != "yield":
+                    return
+                yield value
+
+    def is_available(self):
+        try:
+            self._connect(timeout=0).close()
+            return True
+        except ModelHostUnavailable:
+            return False
+
+    def _connect(self, timeout=MODEL_HOST_CONNECT_TIMEOUT):
+        deadline = time.time() + timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+                return sock
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.time() >= deadline:
+                    raise ModelHostUnavailable("The model host isn't running")
+                time.sleep(0.1)
+
+    def _receive(self, sock):
+        try:
+            kind, value = receive_message(sock)
+        except ConnectionError:
+            raise ModelHostUnavailable("The model host stopped")
+        if kind == "error":
+            name, message = value
+            raise model_host_exceptions.get(name, ModelHostError)(message)
+        return kind, value
+
+
+class ModelHostHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        try:
+            method, args, kwargs = receive_message(self.request)
+        except ConnectionError:
+            # Checking whether the model host is available connects without sending anything
+            return
+
+        result = None
+        try:
+            result = model_host_methods[method](*args, **kwargs)
+            if inspect.isgenerator(result):
+                for item in result:
+                    send_message(self.request, ("yield", item))
+                result = None
+            send_message(self.request, ("return", result))
+        except (BrokenPipeError, ConnectionResetError):
+            # The web server stopped listening, like when a client closes an event stream
+            pass
+        except Exception as e:
+            app.logger.error(traceback.format_exc())
+            send_message(self.request, ("error", (type(e).__name__, str(e))))
+        finally:
+            if inspect.isgenerator(result):
+                result.close()
+
+
+def run_model_host(socket_path):
+    # The one process that loads models and runs inference, so memory use depends on which
+    # models are loaded rather than on how many gunicorn workers there are
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    # Only this user can connect, since messages are pickled
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, ModelHostHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+
+    print(f"Model host listening on {socket_path}")
+    server.serve_forever()
+
+
+def fork_process(target, *args):
+    # A plain fork rather than a multiprocessing.Process: gunicorn workers forked later would
+    # inherit multiprocessing's list of children, and terminate them when they exit
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid:
+        return pid
+
+    exit_code = 1
+    try:
+        target(*args)
+        exit_code = 0
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def supervise_model_host(socket_path, master_pid):
+    # Restarts the model host whenever it dies, and stops it once the gunicorn master is gone
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    pid = None
+    while not stopping.is_set() and os.getppid() == master_pid:
+        if pid is None:
+            pid = fork_process(run_supervised_model_host, socket_path)
+        finished_pid, status = os.waitpid(pid, os.WNOHANG)
+        if finished_pid:
+            exit_code = os.waitstatus_to_exitcode(status)
+            print(f"Model host exited with code {exit_code}, restarting it")
+            pid = None
+        stopping.wait(MODEL_HOST_SUPERVISE_INTERVAL)
+
+    if pid is not None:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+
+def run_supervised_model_host(socket_path):
+    # The supervisor's signal handlers are inherited through the fork
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    run_model_host(socket_path)
+
+
+def start_model_host():
+    """
+    Fork a supervisor that runs the model host and restarts it when it dies. Forked like the
+    gunicorn workers, so the model host shares the metrics and download progress memory. The
+    gunicorn master only reaps the supervisor, so the supervisor can wait on the model host.
+    """
+    socket_path = get_model_host_socket_path()
+    fork_process(supervise_model_host, socket_path, os.getpid())
+    return RemoteModelHost(socket_path)
+
+
+model_host = LocalModelHost()
+
+
 # gunicorn web server stuff
 
 
@@ -690,6 +4711,10 @@ class CustomWSGIApplication(BaseApplication):
 
 
 def run_gunicorn_server():
+    # Start the model host before gunicorn forks its workers, so they all send work to it
+    global model_host
+    model_host = start_model_host()
+
     options = {
         "bind": "127.0.0.1:52014",
         "workers": 4,  # multiprocessing.cpu_count() + 1,
@@ -704,6 +4729,9 @@ def run_gunicorn_server():
 
 
 if __name__ == "__main__":
+    # Needed for parallel transcription worker processes when frozen with PyInstaller
+    multiprocessing.freeze_support()
+
     # run_gunicorn_server()
 
     app.run(debug=True, host="127.0.0.1", port=52014)
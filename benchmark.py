@@ -0,0 +1,871 @@
+"""
+Benchmarks for the backend. Run them from the same virtual environment as backend.py, for example:
+
+    python benchmark.py parallel recording.mp3 --model small --workers 2 4
+    python benchmark.py cpu recording.mp3 --model small --jobs 4
+    python benchmark.py quantized --audio recording.mp3 --text article.txt --language de
+
+The suite runs offline with synthetic audio and text, and randomly initialized tiny models, so
+its results can be saved and compared between versions:
+
+    python benchmark.py --output before.json suite
+    python benchmark.py --output after.json suite
+    python benchmark.py compare before.json after.json
+"""
+
+import argparse
+import http.server
+import json
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+import wave
+
+import numpy as np
+
+# Imported in main(), after the config directory is chosen, since importing the backend
+# creates its model folders and caches
+backend = None
+
+
+def get_metadata():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    except OSError:
+        commit = None
+
+    return {
+        "commit": commit or None,
+        "time": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def print_results(results, output):
+    for result in results:
+        print(
+            "  ".join(
+                f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                for key, value in result.items()
+            )
+        )
+
+    if output:
+        with open(output, "w") as f:
+            json.dump({"metadata": get_metadata(), "results": results}, f, indent=2)
+        print(f"Wrote results to {output}")
+
+
+def benchmark_parallel(args):
+    # Compare the real-time factor (seconds of compute per second of audio) of the serial
+    # windowed transcription against splitting the audio across worker processes
+    audio = backend.decode_audio(args.filename)
+    duration = len(audio) / backend.SAMPLE_RATE
+    print(f"Audio duration: {duration:.1f}s")
+
+    results = []
+    with backend.loaded_models.use(
+        f"whisper/{args.model}",
+        lambda: backend.load_whisper_model(args.model),
+        backend.whisper_ram_estimates[args.model],
+    ) as whisper_model:
+        start_time = time.time()
+        list(
+            backend.iter_transcribe_segments(
+                whisper_model, audio, backend.TRANSCRIBE_WINDOW_SECONDS
+            )
+        )
+        elapsed_time = time.time() - start_time
+        results.append(
+            {
+                "mode": "serial",
+                "workers": 1,
+                "seconds": elapsed_time,
+                "rtf": elapsed_time / duration,
+            }
+        )
+
+        for workers in args.workers:
+            start_time = time.time()
+            backend.transcribe_parallel(args.model, whisper_model, audio, workers)
+            elapsed_time = time.time() - start_time
+            results.append(
+                {
+                    "mode": "parallel",
+                    "workers": workers,
+                    "seconds": elapsed_time,
+                    "rtf": elapsed_time / duration,
+                }
+            )
+
+    print_results(results, args.output)
+
+
+def benchmark_cpu(args):
+    # Aggregate throughput (seconds of audio transcribed per second) with 1 through N
+    # transcriptions running at the same time, with and without the CPU scheduler
+    audio = backend.decode_audio(args.filename)
+    duration = len(audio) / backend.SAMPLE_RATE
+    print(f"Audio duration: {duration:.1f}s")
+
+    def transcribe():
+        # Each job needs its own instance, whisper's kv-cache hooks live on the model
+        with backend.loaded_models.use(
+            f"whisper/{args.model}",
+            lambda: backend.load_whisper_model(args.model),
+            backend.whisper_ram_estimates[args.model],
+            exclusive=True,
+        ) as whisper_model, backend.cpu_scheduler.slot():
+            list(
+                backend.iter_transcribe_segments(
+                    whisper_model, audio, backend.TRANSCRIBE_WINDOW_SECONDS
+                )
+            )
+
+    results = []
+    # Keep the model loaded between runs, so only the first one pays for loading it
+    with backend.loaded_models.use(
+        f"whisper/{args.model}",
+        lambda: backend.load_whisper_model(args.model),
+        backend.whisper_ram_estimates[args.model],
+    ):
+        for scheduler in (False, True):
+            backend.cpu_scheduler.enabled = scheduler
+            for jobs in range(1, args.jobs + 1):
+                threads = [threading.Thread(target=transcribe) for _ in range(jobs)]
+                start_time = time.time()
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed_time = time.time() - start_time
+                result = {
+                    "mode": "scheduler" if scheduler else "default",
+                    "jobs": jobs,
+                    "seconds": elapsed_time,
+                    "throughput": jobs * duration / elapsed_time,
+                }
+                print(
+                    f"{result['mode']}, {jobs} jobs: {result['throughput']:.2f} audio s/s"
+                )
+                results.append(result)
+
+    print_results(results, args.output)
+
+
+def word_error_rate(reference, hypothesis):
+    # Word-level edit distance, divided by the number of words in the reference
+    reference = reference.lower().split()
+    hypothesis = hypothesis.lower().split()
+    distances = list(range(len(hypothesis) + 1))
+    for i, reference_word in enumerate(reference, 1):
+        previous, distances[0] = distances[0], i
+        for j, hypothesis_word in enumerate(hypothesis, 1):
+            previous, distances[j] = distances[j], min(
+                distances[j] + 1,
+                distances[j - 1] + 1,
+                previous + (reference_word != hypothesis_word),
+            )
+    return distances[-1] / max(1, len(reference))
+
+
+def benchmark_quantized(args):
+    # Compare speed and accuracy of the int8 models against the originals. Without a reference
+    # transcript or translation, the original model's output is used as the reference.
+    results = []
+
+    if args.audio:
+        audio = backend.decode_audio(args.audio)
+        duration = len(audio) / backend.SAMPLE_RATE
+        print(f"Audio duration: {duration:.1f}s")
+
+        quantized_model = f"{args.model}{backend.QUANTIZED_SUFFIX}"
+        filename = os.path.join(
+            backend.get_models_dir(), "whisper", f"{quantized_model}.pt"
+        )
+        if not os.path.exists(filename):
+            backend.quantize_whisper_model(args.model)
+
+        texts = {}
+        for model in [args.model, quantized_model]:
+            start_time = time.time()
+            whisper_model = backend.load_whisper_model(model)
+            load_time = time.time() - start_time
+
+            start_time = time.time()
+            segments = backend.iter_transcribe_segments(
+                whisper_model, audio, backend.TRANSCRIBE_WINDOW_SECONDS
+            )
+            texts[model] = "".join(segment["text"] for segment in segments)
+            elapsed_time = time.time() - start_time
+            del whisper_model
+
+            results.append(
+                {
+                    "feature": "transcribe",
+                    "model": model,
+                    "file_size": os.path.getsize(
+                        os.path.join(backend.get_models_dir(), "whisper", f"{model}.pt")
+                    ),
+                    "load_seconds": load_time,
+                    "seconds": elapsed_time,
+                    "rtf": elapsed_time / duration,
+                }
+            )
+
+        reference = texts[args.model]
+        if args.audio_reference:
+            with open(args.audio_reference) as f:
+                reference = f.read()
+        for result in results[-2:]:
+            result["wer"] = word_error_rate(reference, texts[result["model"]])
+
+    if args.text:
+        with open(args.text) as f:
+            paragraphs = backend.split_sentences(f.read())
+        sentences = [sentence for sentences in paragraphs for sentence in sentences]
+        print(f"Sentences: {len(sentences)}")
+
+        model_name = f"opus-mt-{args.language}-en"
+        model_path = os.path.join(backend.get_models_dir(), "Helsinki-NLP", model_name)
+        filename = os.path.join(model_path, backend.helsinki_quantized_filename)
+        if not os.path.exists(filename):
+            backend.quantize_translate_model(model_path)
+
+        translations = {}
+        for quantized in [False, True]:
+            start_time = time.time()
+            tokenizer, model = backend.load_translate_model(model_path, quantized)
+            load_time = time.time() - start_time
+
+            start_time = time.time()
+            translations[quantized] = " ".join(
+                backend.translate_sentences(tokenizer, model, sentences)
+            )
+            elapsed_time = time.time() - start_time
+            del tokenizer, model
+
+            results.append(
+                {
+                    "feature": "translate",
+                    "model": model_name
+                    + (backend.QUANTIZED_SUFFIX if quantized else ""),
+                    "file_size": os.path.getsize(
+                        os.path.join(
+                            model_path,
+                            backend.helsinki_quantized_filename
+                            if quantized
+                            else "pytorch_model.bin",
+                        )
+                    ),
+                    "load_seconds": load_time,
+                    "seconds": elapsed_time,
+                    "sentences_per_second": len(sentences) / elapsed_time,
+                }
+            )
+
+        reference = translations[False]
+        if args.text_reference:
+            with open(args.text_reference) as f:
+                reference = f.read()
+        for result, quantized in zip(results[-2:], [False, True]):
+            result["wer"] = word_error_rate(reference, translations[quantized])
+
+    print_results(results, args.output)
+
+
+# Synthetic fixtures
+
+fixture_words = (
+    "der die das und ist nicht ein eine zu mit auf für von ich sie wir es haus zeit jahr "
+    "tag welt stadt mensch frau mann kind arbeit leben heute morgen immer wieder"
+).split()
+
+
+def write_synthetic_audio(filename, duration, seed=0):
+    # A pitched tone that switches on and off like speech, over a bit of noise
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * backend.SAMPLE_RATE)) / backend.SAMPLE_RATE
+    pitch = 150 + 50 * np.sin(2 * np.pi * 0.5 * t)
+    voiced = np.sin(2 * np.pi * 0.3 * t) > -0.2
+    phase = 2 * np.pi * np.cumsum(pitch) / backend.SAMPLE_RATE
+    audio = 0.3 * voiced * np.sin(phase) + 0.02 * rng.standard_normal(len(t))
+
+    with wave.open(filename, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(backend.SAMPLE_RATE)
+        f.writeframes((np.clip(audio, -1, 1) * 32767).astype("<i2").tobytes())
+
+
+def make_synthetic_text(sentences, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(sentences):
+        words = [rng.choice(fixture_words) for _ in range(rng.randint(5, 15))]
+        lines.append(" ".join(words).capitalize() + ".")
+    # Five sentences per paragraph
+    return "\n".join(" ".join(lines[i : i + 5]) for i in range(0, len(lines), 5))
+
+
+# Decoder layers and heads of the real whisper models. The random models need the same ones,
+# since the backend sets the real model's alignment heads when it loads one.
+whisper_decoder_dims = {
+    "tiny": (4, 6),
+    "base": (6, 8),
+    "small": (12, 12),
+    "medium": (24, 16),
+    "large": (32, 20),
+    "turbo": (4, 20),
+}
+
+
+def make_random_whisper_model(model):
+    import torch
+    import whisper
+
+    quantized = model.endswith(backend.QUANTIZED_SUFFIX)
+    if quantized:
+        model = model[: -len(backend.QUANTIZED_SUFFIX)]
+
+    # A whisper model with the real vocabulary but only small layers
+    name = model.split(".")[0]
+    name = "turbo" if name.endswith("turbo") else name.split("-")[0]
+    n_text_layer, n_text_head = whisper_decoder_dims[name]
+    dims = whisper.model.ModelDimensions(
+        n_mels=80,
+        n_audio_ctx=1500,
+        n_audio_state=8 * n_text_head,
+        n_audio_head=2,
+        n_audio_layer=2,
+        n_vocab=51865,
+        n_text_ctx=448,
+        n_text_state=8 * n_text_head,
+        n_text_head=n_text_head,
+        n_text_layer=n_text_layer,
+    )
+    torch.manual_seed(0)
+    whisper_model = whisper.model.Whisper(dims)
+
+    # Saved the way the backend converts and quantizes downloaded models, so the suite measures
+    # its real loaders. The .pt is only there so the model shows up as downloaded.
+    directory = os.path.join(backend.get_models_dir(), "whisper")
+    os.makedirs(directory, exist_ok=True)
+    torch.save(
+        {"dims": dims.__dict__, "model_state_dict": whisper_model.state_dict()},
+        os.path.join(directory, f"{model}.pt"),
+    )
+    backend.save_safetensors(
+        whisper_model,
+        os.path.join(directory, f"{model}.safetensors"),
+        {"dims": json.dumps(dims.__dict__)},
+    )
+    if quantized:
+        whisper_model = backend.quantize_linear_layers(whisper_model)
+        torch.save(
+            {"dims": dims.__dict__, "model_state_dict": whisper_model.state_dict()},
+            os.path.join(directory, f"{model}{backend.QUANTIZED_SUFFIX}.pt"),
+        )
+
+
+def make_random_translate_model(model_path, text):
+    import sentencepiece
+    import torch
+    import transformers
+
+    # Train a tiny sentencepiece vocabulary on the fixture text, and build a Marian model with
+    # only a few small layers around it
+    os.makedirs(model_path, exist_ok=True)
+    training_filename = os.path.join(model_path, "training.txt")
+    with open(training_filename, "w") as f:
+        f.write(text)
+    sentencepiece.SentencePieceTrainer.train(
+        input=training_filename,
+        model_prefix=os.path.join(model_path, "source"),
+        vocab_size=200,
+        hard_vocab_limit=False,
+        minloglevel=2,
+    )
+    os.remove(training_filename)
+    os.remove(os.path.join(model_path, "source.vocab"))
+    shutil.copy(
+        os.path.join(model_path, "source.model"),
+        os.path.join(model_path, "source.spm"),
+    )
+    shutil.move(
+        os.path.join(model_path, "source.model"),
+        os.path.join(model_path, "target.spm"),
+    )
+
+    processor = sentencepiece.SentencePieceProcessor(
+        model_file=os.path.join(model_path, "source.spm")
+    )
+    vocab = {"</s>": 0, "<unk>": 1}
+    for i in range(processor.get_piece_size()):
+        vocab.setdefault(processor.id_to_piece(i), len(vocab))
+    vocab.pop("<s>", None)
+    vocab = {piece: i for i, piece in enumerate(vocab)}
+    vocab["<pad>"] = len(vocab)
+    with open(os.path.join(model_path, "vocab.json"), "w") as f:
+        json.dump(vocab, f)
+
+    config = transformers.MarianConfig(
+        vocab_size=len(vocab),
+        d_model=64,
+        encoder_layers=2,
+        decoder_layers=2,
+        encoder_attention_heads=2,
+        decoder_attention_heads=2,
+        encoder_ffn_dim=128,
+        decoder_ffn_dim=128,
+        max_position_embeddings=512,
+        pad_token_id=vocab["<pad>"],
+        eos_token_id=0,
+        decoder_start_token_id=vocab["<pad>"],
+        forced_eos_token_id=0,
+    )
+    torch.manual_seed(0)
+    model = transformers.MarianMTModel(config)
+    model.generation_config.max_length = 64
+    model.generation_config.num_beams = 4
+    # Save the same files a downloaded model has. Newer versions of transformers only save
+    # model.safetensors, so save the weights directly.
+    model.config.save_pretrained(model_path)
+    model.generation_config.save_pretrained(model_path)
+    torch.save(model.state_dict(), os.path.join(model_path, "pytorch_model.bin"))
+
+    tokenizer = transformers.MarianTokenizer(
+        source_spm=os.path.join(model_path, "source.spm"),
+        target_spm=os.path.join(model_path, "target.spm"),
+        vocab=os.path.join(model_path, "vocab.json"),
+    )
+    tokenizer.save_pretrained(model_path)
+
+
+def serve_bytes(data):
+    # A local stand-in for the model servers, with range request support
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            start, end = 0, len(data) - 1
+            match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+            if match:
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(end, int(match.group(2)))
+                if start >= len(data):
+                    self.send_response(416)
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            else:
+                self.send_response(200)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            self.wfile.write(memoryview(data)[start : end + 1])
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# Suite
+
+
+def get_process_peak_rss():
+    # The most memory the benchmark process has used so far, not just during one case, since
+    # ru_maxrss is never reset. It's in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(name, fn, **fields):
+    start_time = time.time()
+    value = fn()
+    result = {
+        "name": name,
+        "seconds": time.time() - start_time,
+        **fields,
+        "process_peak_rss": get_process_peak_rss(),
+    }
+    print(f"{name}: {result['seconds']:.3f}s")
+    return result, value
+
+
+def measure_concurrently(name, clients, requests_per_client, fn):
+    # Each client sends its requests one after another, and all clients run at the same time
+    latencies = []
+    lock = threading.Lock()
+
+    def client(i):
+        for j in range(requests_per_client):
+            start_time = time.time()
+            fn(i, j)
+            with lock:
+                latencies.append(time.time() - start_time)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed_time = time.time() - start_time
+
+    latencies.sort()
+    result = {
+        "name": name,
+        "clients": clients,
+        "requests": len(latencies),
+        "seconds": elapsed_time,
+        "throughput": len(latencies) / elapsed_time,
+        "latency_p50": statistics.median(latencies),
+        "latency_p95": latencies[int(0.95 * (len(latencies) - 1))],
+        "process_peak_rss": get_process_peak_rss(),
+    }
+    print(f"{name}: {result['throughput']:.3f} requests/s")
+    return result
+
+
+def benchmark_suite_transcribe(args, audio_filename, duration):
+    results = []
+    model = args.model
+    client = backend.app.test_client()
+
+    def transcribe(use_cache=False):
+        transcription = backend.do_transcribe(
+            model,
+            audio_filename,
+            use_cache=use_cache,
+            workers=1,
+            diarize_speakers=False,
+        )
+        assert transcription["success"]
+
+    def transcribe_route(_=None, __=None):
+        response = client.post(
+            "/transcribe",
+            json={
+                "filename": audio_filename,
+                "model": model,
+                "cache": False,
+                "diarize": False,
+            },
+        )
+        assert response.json["success"], response.json
+
+    backend.loaded_models.unload(f"whisper/{model}")
+    result, _ = measure("transcribe.cold", transcribe)
+    results.append({**result, "rtf": result["seconds"] / duration})
+    result, _ = measure("transcribe.warm", transcribe)
+    results.append({**result, "rtf": result["seconds"] / duration})
+
+    transcribe(use_cache=True)
+    result, _ = measure("transcribe.cached", lambda: transcribe(use_cache=True))
+    results.append(result)
+
+    backend.loaded_models.unload(f"whisper/{model}")
+    result, _ = measure("transcribe.route.cold", transcribe_route)
+    results.append({**result, "rtf": result["seconds"] / duration})
+    result, _ = measure("transcribe.route.warm", transcribe_route)
+    results.append({**result, "rtf": result["seconds"] / duration})
+
+    for clients in args.clients:
+        results.append(
+            measure_concurrently(
+                f"transcribe.route.concurrent.{clients}",
+                clients,
+                args.requests,
+                transcribe_route,
+            )
+        )
+    return results
+
+
+def benchmark_suite_translate(args):
+    results = []
+    language = args.language
+    client = backend.app.test_client()
+
+    # Every call gets different text, so the translation memory doesn't answer it
+    seeds = iter(range(1, 1000000))
+    texts_lock = threading.Lock()
+
+    def next_text():
+        with texts_lock:
+            return make_synthetic_text(args.sentences, next(seeds))
+
+    def translate(text=None):
+        translation = backend.do_translate(text or next_text(), language)
+        assert translation["success"]
+
+    def translate_route(_=None, __=None):
+        response = client.post(
+            "/translate", json={"sourceText": next_text(), "sourceLanguage": language}
+        )
+        assert response.json["success"], response.json
+
+    backend.loaded_models.unload(f"Helsinki-NLP/opus-mt-{language}-en")
+    result, _ = measure("translate.cold", translate, sentences=args.sentences)
+    results.append(result)
+    result, _ = measure("translate.warm", translate, sentences=args.sentences)
+    results.append(result)
+
+    text = next_text()
+    translate(text)
+    result, _ = measure(
+        "translate.memory", lambda: translate(text), sentences=args.sentences
+    )
+    results.append(result)
+
+    result, _ = measure("translate.route.warm", translate_route)
+    results.append(result)
+
+    for clients in args.clients:
+        results.append(
+            measure_concurrently(
+                f"translate.route.concurrent.{clients}",
+                clients,
+                args.requests,
+                translate_route,
+            )
+        )
+
+    # The same concurrent load with different batch windows, where 0 only batches requests
+    # that arrive at the same moment
+    batcher = backend.translation_batcher
+    default_window = batcher.window
+    clients = max(args.clients)
+    try:
+        for window in args.batch_windows:
+            batcher.window = window / 1000
+            results.append(
+                measure_concurrently(
+                    f"translate.batch_window.{window:g}ms.{clients}",
+                    clients,
+                    args.requests,
+                    lambda _, __: translate(),
+                )
+            )
+    finally:
+        batcher.window = default_window
+    return results
+
+
+def benchmark_suite_download(args, work_dir):
+    results = []
+    data = np.random.default_rng(0).bytes(args.download_mb * backend.MB)
+    server = serve_bytes(data)
+    url = f"http://127.0.0.1:{server.server_port}/model.bin"
+    filename = os.path.join(work_dir, "model.bin")
+
+    try:
+        for connections in [1, backend.DOWNLOAD_CONNECTIONS]:
+            result, _ = measure(
+                f"download.connections.{connections}",
+                lambda: backend.FileDownload(
+                    url, filename, connections=connections
+                ).run(),
+                bytes=len(data),
+            )
+            results.append(
+                {**result, "mb_per_second": args.download_mb / result["seconds"]}
+            )
+            os.remove(filename)
+
+        # The whole download() path, with progress reporting
+        status = backend.DownloadStatus.claim("benchmark")
+        try:
+            with backend.app.app_context():
+                result, error = measure(
+                    "download.progress",
+                    lambda: backend.download(url, filename, status, "benchmark"),
+                    bytes=len(data),
+                )
+        finally:
+            status.clean()
+        assert error is None, error.json
+        results.append(
+            {**result, "mb_per_second": args.download_mb / result["seconds"]}
+        )
+    finally:
+        server.shutdown()
+    return results
+
+
+def benchmark_suite(args):
+    work_dir = tempfile.mkdtemp(prefix="neuronbox-benchmark-")
+    results = []
+    try:
+        audio_filename = os.path.join(work_dir, "speech.wav")
+        write_synthetic_audio(audio_filename, args.duration)
+
+        if not args.installed_models:
+            # Never write random models over the real ones
+            models_dir = backend.get_models_dir()
+            if os.path.commonpath([models_dir, args.config_dir]) != args.config_dir:
+                raise SystemExit(
+                    f"The models folder {models_dir} isn't in the suite's temporary folder"
+                )
+
+            make_random_whisper_model(args.model)
+            make_random_translate_model(
+                os.path.join(models_dir, "Helsinki-NLP", f"opus-mt-{args.language}-en"),
+                make_synthetic_text(1000),
+            )
+            backend.model_catalog.invalidate()
+
+        if "transcribe" not in args.skip:
+            results += benchmark_suite_transcribe(args, audio_filename, args.duration)
+        if "translate" not in args.skip:
+            results += benchmark_suite_translate(args)
+        if "download" not in args.skip:
+            results += benchmark_suite_download(args, work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(results, args.output)
+
+
+def benchmark_compare(args):
+    # Shows how every number changed between two saved suite runs
+    with open(args.before) as f:
+        before = {result["name"]: result for result in json.load(f)["results"]}
+    with open(args.after) as f:
+        after = {result["name"]: result for result in json.load(f)["results"]}
+
+    for name, result in after.items():
+        if name not in before:
+            continue
+        for key, value in result.items():
+            old_value = before[name].get(key)
+            if key == "name" or not isinstance(value, (int, float)) or not old_value:
+                continue
+            print(
+                f"{name}  {key}: {old_value:.3f} -> {value:.3f} ({value / old_value:.2f}x)"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the NeuronBox backend")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parallel_parser = subparsers.add_parser(
+        "parallel", help="Serial vs. parallel transcription of a recording"
+    )
+    parallel_parser.add_argument("filename", help="Audio file to transcribe")
+    parallel_parser.add_argument("--model", default="small")
+    parallel_parser.add_argument(
+        "--workers", type=int, nargs="+", default=[2, 4], help="Worker counts to try"
+    )
+    parallel_parser.set_defaults(func=benchmark_parallel)
+
+    cpu_parser = subparsers.add_parser(
+        "cpu",
+        help="Throughput of concurrent transcriptions, with and without the CPU scheduler",
+    )
+    cpu_parser.add_argument("filename", help="Audio file to transcribe")
+    cpu_parser.add_argument("--model", default="small")
+    cpu_parser.add_argument(
+        "--jobs", type=int, default=4, help="Try 1 through this many jobs at once"
+    )
+    cpu_parser.set_defaults(func=benchmark_cpu)
+
+    quantized_parser = subparsers.add_parser(
+        "quantized", help="Original vs. int8 quantized models, speed and accuracy"
+    )
+    quantized_parser.add_argument("--audio", help="Audio file to transcribe")
+    quantized_parser.add_argument("--audio-reference", help="Correct transcript")
+    quantized_parser.add_argument("--model", default="small")
+    quantized_parser.add_argument("--text", help="Text file to translate")
+    quantized_parser.add_argument("--text-reference", help="Correct translation")
+    quantized_parser.add_argument("--language", default="de", help="Language of --text")
+    quantized_parser.set_defaults(func=benchmark_quantized)
+
+    suite_parser = subparsers.add_parser(
+        "suite",
+        help="Offline latency, throughput and memory benchmarks with synthetic fixtures",
+    )
+    suite_parser.add_argument(
+        "--installed-models",
+        action="store_true",
+        help="Use the installed models, instead of random tiny ones in a temporary folder",
+    )
+    suite_parser.add_argument("--model", default="small")
+    suite_parser.add_argument("--language", default="de")
+    suite_parser.add_argument(
+        "--duration", type=float, default=60, help="Seconds of audio to transcribe"
+    )
+    suite_parser.add_argument(
+        "--sentences", type=int, default=20, help="Sentences per translation"
+    )
+    suite_parser.add_argument(
+        "--clients", type=int, nargs="+", default=[1, 4], help="Concurrent clients"
+    )
+    suite_parser.add_argument(
+        "--requests", type=int, default=2, help="Requests per concurrent client"
+    )
+    suite_parser.add_argument(
+        "--batch-windows",
+        type=float,
+        nargs="+",
+        default=[0, 10, 50],
+        help="Translation batch windows to try, in milliseconds",
+    )
+    suite_parser.add_argument("--download-mb", type=int, default=64)
+    suite_parser.add_argument(
+        "--skip",
+        nargs="+",
+        default=[],
+        choices=["transcribe", "translate", "download"],
+    )
+    suite_parser.set_defaults(func=benchmark_suite)
+
+    compare_parser = subparsers.add_parser(
+        "compare", help="Compare two results files written with --output"
+    )
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.set_defaults(func=benchmark_compare)
+
+    args = parser.parse_args()
+
+    # Keep the suite's random models and caches away from the real ones
+    config_dir = None
+    if args.func is benchmark_suite and not args.installed_models:
+        config_dir = tempfile.mkdtemp(prefix="neuronbox-config-")
+        os.environ["NEURONBOX_CONFIG_DIR"] = config_dir
+    args.config_dir = config_dir
+
+    global backend
+    if args.func is not benchmark_compare:
+        import backend
+
+    try:
+        args.func(args)
+    finally:
+        if config_dir:
+            shutil.rmtree(config_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()